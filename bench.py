@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# Benchmarks over synthetic sheets shaped like batchGet output, no credentials or network needed.  Run from the
+# app directory, main needs SETTINGS_FILE (default settings.cfg):
+#   python3 bench.py --sizes 1x1x1,5x3x2,20x10x4 --output bench.json
+
+import argparse
+import contextlib
+import datetime
+import http.server
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import types
+import urllib.parse
+
+import dateutil.parser
+import google.auth.credentials
+import google_auth_httplib2
+import googleapiclient.discovery
+import googleapiclient.http
+
+os.environ.setdefault('SETTINGS_FILE', 'settings.cfg')
+
+import calc
+import data
+import main
+import snapshot
+
+FIRST = ['Jane', 'Mary', 'Ann', 'Sue', 'Kate', 'Liz', 'Amy', 'Beth', 'Cara', 'Dana']
+KIDS  = ['Alice', 'Ben', 'Cole', 'Dora', 'Evan', 'Fay', 'Gus', 'Hope']
+
+
+def nanny_names(count):
+    return ['{}{} Sample'.format(FIRST[ii % len(FIRST)], ii // len(FIRST) or '') for ii in range(count)]
+
+
+def child_names(count):
+    return ['{}{}'.format(KIDS[ii % len(KIDS)], ii // len(KIDS) or '') for ii in range(count)]
+
+
+def synthetic(year, nannies, children, seed=0):
+    # {range name: valueRange} for one year's spreadsheet
+    rnd    = random.Random('{}-{}'.format(seed, year))
+    kids   = child_names(children)
+    ranges = dict()
+
+    config = list()
+    for ii, name in enumerate(nannies, 1):
+        config.append(['Nanny {}'.format(ii), '{}\n{} Main St\nSeattle WA\n555-00-{:04d}'.format(name, ii, ii)])
+        config.append(['SickAccum {}'.format(ii), '40'])
+    for ii, kid in enumerate(kids, 1):
+        config.append(['Child {}'.format(ii), '{} Sample'.format(kid)])
+        config.append(['Employer {}'.format(ii), 'Sample{} Family 00-000000{}'.format(ii, ii)])
+    config += [['Social Security', '12.4%'], ['Medicare', '2.9%'], ['Fed Unemployment', '0.6%'], ['Fed Unemployment Base', '7,000'],
+               ['WA Wage Base', '52,700'], ['Family Leave', '0.153%'], ['WA Unemployment', '1.2%']]
+    ranges['Config'] = dict(values=config)
+
+    periods = [['Start', 'End', 'PayDate'] + ['{} {}'.format(n, c) for n in nannies for c in ('Rates', 'Withholding')]]
+    start   = datetime.date(year, 1, 1)
+    while start.year == year:
+        end = start + datetime.timedelta(days=13)
+        row = [start.strftime('%m/%d/%Y'), end.strftime('%m/%d/%Y'), (end + datetime.timedelta(days=5)).strftime('%m/%d/%Y')]
+        for ii, name in enumerate(nannies):
+            base = 20 + ii % 5 + (start.month > 6)
+            row.append('{}, {}, {}, {}'.format(base, base + 5, base * 1.5, (base + 5) * 1.5))
+            row.append(year <= 2019 and '{}, 2, 0'.format(ii % 2) or '{}, 0, 0, 0, 0, 0'.format(ii % 2))
+        periods.append(row)
+        start = end + datetime.timedelta(days=1)
+    ranges['PayPeriods'] = dict(values=periods)
+
+    if year <= 2019:
+        brackets = [['Wages'] + [str(ii) for ii in range(10)]]
+        for amount in range(0, 5000, 20):
+            brackets.append(['{:,}'.format(amount)] + ['{:.2f}'.format(max(0, (amount - 80 * ii) * 0.1)) for ii in range(10)])
+        ranges['Single Bracket'] = ranges['Married Bracket'] = dict(values=brackets)
+    else:
+        tables = list()
+        for married in (0, 1):
+            for twojobs in (0, 1):
+                tables += [['w4[0]={}'.format(married)], ['w4[1]={}'.format(twojobs)]]
+                low = 0
+                for high, base, rate in [(10000, 0, '0%'), (30000, 0, '10%'), (80000, 2000, '12%'), (170000, 8000, '22%'), (99999999, 28000, '24%')]:
+                    tables.append(['{:,}'.format(low), '{:,}'.format(high), '{:,}'.format(base), rate, married and '12,900' or '8,600'])
+                    low = high
+        ranges['Tax Tables'] = dict(values=tables)
+
+    header = ['Day', 'Date'] + [k + s for k in kids for s in ('', ' OT')] + ['Both', 'Both OT', 'Sick', 'Holiday', 'Sick Adjust']
+    for name in nannies:
+        hours = [['Hours'], header]
+        day   = datetime.date(year, 1, 1)
+        while day.year == year:
+            if day.weekday() < 5:
+                row = [day.strftime('%a'), day.strftime('%m/%d/%Y')]
+                for col in header[2:]:
+                    chance = 'OT' in col and 0.1 or col in ('Sick', 'Holiday') and 0.03 or col == 'Sick Adjust' and 0.01 or 0.5
+                    row.append(rnd.random() < chance and '{:.2f}'.format(rnd.randint(1, 36) / 4) or '')
+                hours.append(row)
+            day += datetime.timedelta(days=1)
+        ranges['{} Hours'.format(name)] = dict(values=hours)
+
+        reimbursements = [['Reimbursements'], ['Date', 'Amount', 'Notes']]
+        day = datetime.date(year, 1, 3)
+        while day.year == year:
+            reimbursements.append([day.strftime('%m/%d/%Y'), '{:,.2f}'.format(rnd.randint(100, 90000) / 100), 'mileage'])
+            day += datetime.timedelta(days=rnd.randint(5, 20))
+        ranges['{} Reimbursements'.format(name)] = dict(values=reimbursements)
+
+    return ranges
+
+
+@contextlib.contextmanager
+def patched(app, **attrs):
+    # data module attributes and the app config only changed for the block, main stays usable afterwards
+    saved   = {name: getattr(data, name) for name in attrs}
+    config  = dict(app.config)
+    clients = dict(data._clients)
+    try:
+        for name, value in attrs.items():
+            setattr(data, name, value)
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(data, name, value)
+        app.config.clear()
+        app.config.update(config)
+        data._clients.clear()
+        data._clients.update(clients)
+
+
+def timed(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_dates(number=20):
+    day  = datetime.date(2020, 1, 1)
+    rows = [(day + datetime.timedelta(days=ii)).strftime('%m/%d/%Y') for ii in range(366)]
+    old  = timeit.timeit(lambda: [dateutil.parser.parse(r) for r in rows], number=number) / number
+    new  = timeit.timeit(lambda: [data.str2date(r) for r in rows], number=number) / number
+    return dict(dateutil=old, str2date=new)
+
+
+def stub_discovery(root):
+    # just enough of the Sheets v4 discovery document for values().batchGet()
+    batchget = dict(id='sheets.spreadsheets.values.batchGet', path='v4/spreadsheets/{spreadsheetId}/values:batchGet', httpMethod='GET',
+                    parameters=dict(spreadsheetId=dict(type='string', required=True, location='path'),
+                                    ranges=dict(type='string', repeated=True, location='query')),
+                    parameterOrder=['spreadsheetId'], response={'$ref': 'BatchGetValuesResponse'})
+    return dict(kind='discovery#restDescription', discoveryVersion='v1', id='sheets:v4', name='sheets', version='v4', protocol='rest',
+                rootUrl=root, servicePath='', baseUrl=root, batchPath='batch', parameters=dict(),
+                schemas=dict(BatchGetValuesResponse=dict(id='BatchGetValuesResponse', type='object')),
+                resources=dict(spreadsheets=dict(resources=dict(values=dict(methods=dict(batchGet=batchget))))))
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # local stand in for the discovery and Sheets endpoints, counts connections so keep-alive shows up
+    protocol_version = 'HTTP/1.1'
+    wbufsize         = -1      # headers and body in one write, otherwise delayed ACKs swamp the timings
+    disable_nagle_algorithm = True
+    connections      = 0
+
+    def setup(self):
+        super().setup()
+        StubHandler.connections += 1
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith('/discovery/'):
+            body = json.dumps(self.server.discovery).encode()
+        else:
+            sheetid = urllib.parse.unquote(url.path.split('/')[3].split(':')[0])
+            ranges  = urllib.parse.parse_qs(url.query).get('ranges', [])
+            body    = json.dumps(dict(spreadsheetId=sheetid, valueRanges=[self.server.sheets[sheetid][r] for r in ranges])).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_client(requests=50):
+    # Sheets client startup and per request cost against a local stub server: building the client for every request
+    # (discovery fetch and new connections each time) against the shared process wide client
+    sheets = {'bench2020': synthetic(2020, nanny_names(1), 2)}
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    root   = 'http://127.0.0.1:{}/'.format(server.server_port)
+    server.discovery, server.sheets = stub_discovery(root), sheets
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    ranges = ['Config', 'PayPeriods']
+    ret    = dict()
+    anon   = google.auth.credentials.AnonymousCredentials()
+
+    def perrequest():
+        http    = google_auth_httplib2.AuthorizedHttp(anon, http=googleapiclient.http.build_http())
+        service = googleapiclient.discovery.build('sheets', 'v4', http=http, discoveryServiceUrl=root + 'discovery/{api}/{apiVersion}', cache_discovery=False)
+        service.spreadsheets().values().batchGet(spreadsheetId='bench2020', ranges=ranges).execute()
+
+    StubHandler.connections = 0
+    ret['per_request_build'] = timeit.timeit(perrequest, number=requests) / requests
+    ret['per_request_build_connections'] = StubHandler.connections
+
+    with tempfile.TemporaryDirectory() as discovery:
+        with open(os.path.join(discovery, 'sheets.v4.json'), 'w') as fp:
+            json.dump(server.discovery, fp)
+        # the stub is the only host the document may point at
+        with patched(main.app, GOOGLEAPIS=re.compile(re.escape(root)), credentials=anon), main.app.app_context():
+            main.app.config.update(DISCOVERY_DIR=discovery, SHEETS_BACKEND='google')
+            data._clients.clear()
+            StubHandler.connections = 0
+            start = time.perf_counter()
+            data._get_api().values().batchGet(spreadsheetId='bench2020', ranges=ranges).execute()
+            ret['shared_first'] = time.perf_counter() - start
+            ret['shared'] = timeit.timeit(lambda: data._get_api().values().batchGet(spreadsheetId='bench2020', ranges=ranges).execute(), number=requests) / requests
+        ret['shared_connections'] = StubHandler.connections
+
+    # importing data no longer reads creds.json
+    cmd = [sys.executable, '-c', 'import time; t = time.perf_counter(); import data; print(time.perf_counter() - t)']
+    ret['import_data'] = min(float(subprocess.check_output(cmd, cwd=os.path.dirname(os.path.abspath(data.__file__)))) for ii in range(3))
+
+    server.shutdown()
+    return ret
+
+
+def bench_size(nanny_count, year_count, child_count, first_year, repeat, latency=0, snapshotdir=None):
+    nannies = nanny_names(nanny_count)
+    years   = list(range(first_year, first_year + year_count))
+    sheets  = {'bench{}'.format(y): synthetic(y, nannies, child_count) for y in years}
+    ret     = dict(nannies=nanny_count, years=year_count, children=child_count, phases=dict())
+    phases  = ret['phases']
+
+    if snapshotdir:
+        version = '{}x{}x{}'.format(nanny_count, year_count, child_count)
+        for sheetid, ranges in sheets.items():
+            snapshot.save(snapshotdir, sheetid, version, list(ranges), dict(valueRanges=list(ranges.values())))
+
+    parsed = dict()
+    def parse():
+        for y in years:
+            ranges = sheets['bench{}'.format(y)]
+            periods = data.PayPeriod.parseSheet(ranges['PayPeriods'])
+            parsed[y] = [data.Config(ranges['Config']), periods, data.TaxTablesPre20(ranges['Single Bracket'], ranges['Married Bracket']) if y <= 2019
+                         else data.TaxTablesPost20(ranges['Tax Tables']), dict()]
+            for name in nannies:
+                parsed[y][3][name] = types.SimpleNamespace(hours=data.Hours.parseSheet(ranges['{} Hours'.format(name)]),
+                                        reimbursements=data.Reimbursement.parseSheet(ranges['{} Reimbursements'.format(name)]))
+                hours = parsed[y][3][name].hours
+                for column in hours.names:  # columns convert on first use, do it here so calculate is only the calc
+                    hours.column(column)
+    phases['parse'] = timed(parse, repeat)
+
+    def calculate(fixed):
+        for y in years:
+            sconfig, periods, taxtables, ndata = parsed[y]
+            for name in nannies:
+                calc.nanny_calculate(sconfig, periods, taxtables, name, ndata[name], fixed=fixed)
+    phases['calculate']       = timed(lambda: calculate(False), repeat)
+    phases['calculate_fixed'] = timed(lambda: calculate(True), repeat)
+
+    # full requests with cold caches, the sheets come from FakeSheets so this is fetch latency + parse + calc + render
+    app = main.app
+    client = app.test_client()
+
+    def render(urls):
+        for url in urls:
+            data.sheetcache.invalidate()
+            resp = client.get(url)
+            if resp.status_code != 200:
+                raise RuntimeError("{} returned {}".format(url, resp.status_code))
+
+    lastend  = lambda y: parsed[y][1][-1].endDate().strftime('%Y_%m_%d')
+    with patched(app, _get_api=lambda: snapshot.FakeSheets(lambda sheetid, range_: sheets[sheetid][range_], latency)):
+        app.config.update({'SPREADSHEET_ID_{}'.format(y): 'bench{}'.format(y) for y in years})
+        app.config.update(SHEETS_REVISION_CHECK=False, RESULTS_STORE='')
+        phases['render_tax']     = timed(lambda: render(['/{}/tax'.format(y) for y in years]), repeat)
+        phases['render_paystub'] = timed(lambda: render(['/{}/paystub/{}/{}'.format(y, lastend(y), nannies[0]) for y in years]), repeat)
+    data.sheetcache.invalidate()
+
+    ret['hours_rows'] = sum(len(sheets['bench{}'.format(y)]['{} Hours'.format(n)]['values']) - 2 for y in years for n in nannies)
+    return ret
+
+
+def main_():
+    parser = argparse.ArgumentParser(description="nanny-reports benchmarks")
+    parser.add_argument('--sizes',  default='1x1x1,3x1x2,5x3x3,20x10x4', help="comma list of NANNIESxYEARSxCHILDREN")
+    parser.add_argument('--first-year', type=int, default=2020)
+    parser.add_argument('--repeat', type=int, default=3, help="best of this many runs")
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to each batchGet")
+    parser.add_argument('--snapshot', help="also write the generated sheets to this snapshot directory, one version per size")
+    parser.add_argument('--output', default='bench.json')
+    args = parser.parse_args()
+
+    results = dict(when=time.strftime('%Y-%m-%dT%H:%M:%S'), dates=bench_dates(), client=bench_client(), sizes=list())
+    print("client  " + "  ".join("{} {:.4g}".format(k, v) for k, v in results['client'].items()))
+    for size in args.sizes.split(','):
+        nannies, years, children = map(int, size.split('x'))
+        result = bench_size(nannies, years, children, args.first_year, args.repeat, args.latency, args.snapshot)
+        results['sizes'].append(result)
+        print("{:>9} {:>7} rows  ".format(size, result['hours_rows']) + "  ".join("{} {:.3f}s".format(k, v) for k, v in result['phases'].items()))
+
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main_()
@@ -1,5 +1,7 @@
+import bisect
 import collections
 import decimal
+import itertools
 from functools import partial
 
 SING   = 0
@@ -17,11 +19,8 @@ def sr(index, hours, rates):
 def srh(index, hours, rates):
     return sr(index, hours/2, rates)
 
-def nanny_calculate(sconfig, periods, taxtables, nanny, ndata):
-
-    ret = dict()
+def _hours_calcs(sconfig):
     calcs = list()
-
     for child in sconfig.children:
         #             Input Hours Key,  Rate Function,        Destination Keys
         calcs.append(   ('Both',        partial(srh, BOTH),   [child + ' Gross', child + ' Both']))
@@ -30,74 +29,313 @@ def nanny_calculate(sconfig, periods, taxtables, nanny, ndata):
         calcs.append(   ('Holiday',     partial(srh, BOTH),   [child + ' Gross', child + ' Holiday']))
         calcs.append(   (child,         partial(sr, SING),    [child + ' Gross', child]))
         calcs.append(   (child + ' OT', partial(sr, SINGOT),  [child + ' Gross', child + ' OT']))
-
-
-
-    for period in periods:
+    return calcs
+
+
+def _row_calc(calcs, rates, hours, idx):
+    for hrkey, ratefunc, dkeys in calcs:
+        hrs, gross = ratefunc(hours.hours(hrkey, idx), rates)
+        yield hrkey, hrs, gross, dkeys
+
+
+class DecimalRows():
+    # Reference row engine, Decimal hours and money as they come from the sheet
+    zero  = decimal.Decimal
+    scale = None
+
+    def __init__(self, sconfig, nanny, hours):
+        self.sconfig = sconfig
+        self.nanny   = nanny
+        self.hours   = hours
+        self.calcs   = _hours_calcs(sconfig)
+
+    def calc(self, rates, idx):            return _row_calc(self.calcs, rates, self.hours, idx)
+    def adjust(self, idx):                 return self.hours.hours('Sick Adjust', idx)
+    def accrue(self, hrs, hrkey, idx):     return self.sconfig.sickaccum(self.nanny, hrs)
+    def sick(self, hrs, idx):              return hrs
+    def hoursout(self, values, idxs):      return values
+    def ytdhoursout(self, values, count):  return values
+    def sumsout(self, values, count=0):    return values
+
+
+class FixedRows():
+    # Opt in integer engine.  Hours are ints with one more decimal place than the sheet uses so halving stays exact,
+    # money is int cents rounded half even just like quantize(CENTS), and SickAccum is an int as well when the
+    # accrual rate divides evenly (otherwise it is figured from the Decimal hours).  Values go back to Decimal as
+    # each period is done, with the exponent the Decimal sums would have: the smallest of 0 and the summed values'.
+    zero = int
+
+    def __init__(self, sconfig, nanny, hours):
+        calcs        = _hours_calcs(sconfig)
+        self.digits  = hours.digits([hrkey for hrkey, ratefunc, dkeys in calcs] + ['Sick Adjust']) + 1
+        self.calcs   = list()
+        self.halves  = set()
+        columns      = dict()
+        for hrkey, ratefunc, dkeys in calcs:
+            if hrkey not in columns:
+                columns[hrkey] = hours.scaled(hrkey, self.digits)
+            half = ratefunc.func is srh
+            if half: self.halves.add(hrkey)
+            self.calcs.append((hrkey, columns[hrkey], half, ratefunc.args[0], dkeys))
+        self.adjusts = hours.scaled('Sick Adjust', self.digits)
+        self.rates   = (None, None)
+
+        # hrs/hoursper is exact in fixed point when hoursper is 2**a * 5**b * 10**e
+        self.sconfig    = sconfig
+        self.nanny      = nanny
+        self.hours      = hours
+        self.sickdigits = None
+        hoursper = sconfig.hoursper.get(nanny)
+        if hoursper is not None and hoursper > 0:
+            exp   = hoursper.as_tuple().exponent
+            coeff = n = int(hoursper.scaleb(-exp))
+            a = b = 0
+            while n % 2 == 0: n, a = n // 2, a + 1
+            while n % 5 == 0: n, b = n // 5, b + 1
+            if n == 1:
+                c = max(a, b)
+                self.sickdigits = max(self.digits, self.digits + c + exp)
+                self.accrual    = (10**c // coeff) * 10**(self.sickdigits - self.digits - c - exp)
+                self.sickmult   = 10**(self.sickdigits - self.digits)
+        self.scale = (self.digits, self.sickdigits)  # what the ledger's running ints are in
+
+        # exponent of each row's Decimal value per destination key, and running minimums for the YTD keys and SickAccum
+        self.keyexps = dict()
+        rowexps      = dict()
+        sickexps     = self.exponents(hours, 'Sick Adjust', lambda v: v)
+        for hrkey, column, half, index, dkeys in self.calcs:
+            if hrkey not in rowexps:
+                value = half and (lambda v: v/2) or (lambda v: v)
+                rowexps[hrkey] = self.exponents(hours, hrkey, value)
+                if hrkey not in ('Sick', 'Holiday') and self.sickdigits is not None:
+                    accrue   = self.exponents(hours, hrkey, lambda v, value=value: sconfig.sickaccum(nanny, value(v)))
+                    sickexps = list(map(min, sickexps, accrue))
+                elif hrkey == 'Sick':
+                    sickexps = list(map(min, sickexps, rowexps[hrkey]))
+            for dkey in dkeys:
+                self.keyexps[dkey] = list(map(min, self.keyexps.get(dkey, rowexps[hrkey]), rowexps[hrkey]))
+        self.ytdexps  = {dkey + ' YTD': list(itertools.accumulate(exps, min)) for dkey, exps in self.keyexps.items()}
+        self.sickexps = list(itertools.accumulate(sickexps, min))
+
+    @staticmethod
+    def exponents(hours, name, func):
+        # exponent of func(value) for each row of the column, func runs once per distinct value
+        column = hours.column(name)
+        if column is None:
+            return [func(decimal.Decimal(0)).as_tuple().exponent] * len(hours)
+        exps = {v: func(dec).as_tuple().exponent for v, dec in column[1].items()}
+        return [exps[v] for v in column[0]]
+
+    @staticmethod
+    def todec(value, digits, exp):
+        # value in units of 10**-digits as a Decimal with exponent exp, no smaller than -digits
+        return decimal.Decimal(value // 10**(digits + exp)).scaleb(exp)
+
+    def rate(self, rate):
+        places = max(0, -rate.as_tuple().exponent)
+        return int(rate.scaleb(places)), 10**(self.digits + places - 2)
+
+    def calc(self, rates, idx):
+        if rates is not self.rates[0]:
+            self.rates = (rates, [self.rate(r) for r in rates])
+        fixed = self.rates[1]
+        for hrkey, column, half, index, dkeys in self.calcs:
+            hrs = column[idx]
+            if half: hrs //= 2
+            rint, div = fixed[index]
+            gross = hrs * rint
+            q, r = divmod(abs(gross), div)
+            if r*2 > div or (r*2 == div and q & 1): q += 1
+            yield hrkey, hrs, gross < 0 and -q or q, dkeys
+
+    def dechours(self, hrkey, idx):
+        hrs = self.hours.hours(hrkey, idx)
+        if hrkey in self.halves: return hrs/2
+        return hrs
+
+    def adjust(self, idx):
+        if self.sickdigits is None: return self.hours.hours('Sick Adjust', idx)
+        return self.adjusts[idx] * self.sickmult
+
+    def accrue(self, hrs, hrkey, idx):
+        if self.sickdigits is None: return self.sconfig.sickaccum(self.nanny, self.dechours(hrkey, idx))
+        return hrs * self.accrual
+
+    def sick(self, hrs, idx):
+        if self.sickdigits is None: return self.dechours('Sick', idx)
+        return hrs * self.sickmult
+
+    def hoursout(self, values, idxs):
+        # period hours summed over the rows idxs
+        ret = dict()
+        for key, value in values.items():
+            exps = self.keyexps[key]
+            ret[key] = self.todec(value, self.digits, min([0] + [exps[idx] for idx in idxs]))
+        return ret
+
+    def ytdhoursout(self, values, count):
+        # YTD hours summed over the first count rows
+        return {k: self.todec(v, self.digits, count and min(0, self.ytdexps[k][count-1])) for k, v in values.items()}
+
+    def sumsout(self, values, count=0):
+        ret = {k: decimal.Decimal(v).scaleb(-2) for k, v in values.items() if k != 'SickAccum'}
+        if 'SickAccum' in values:
+            sick = values['SickAccum']
+            if self.sickdigits is not None:
+                sick = self.todec(sick, self.sickdigits, count and min(0, self.sickexps[count-1]))
+            ret['SickAccum'] = sick
+        return ret
+
+
+class Ledger():
+    # Running totals of the forward sweep, a copy taken at a period end is all that is needed to carry on from there
+    TOTALS = ('ytdh', 'ytds', 'reimb', 'tax', 'quarters')
+
+    def __init__(self, zero=decimal.Decimal):
+        self.zero  = zero
+        self.scale = None
+        self.rates = None
+        self.hidx  = 0
+        self.ridx  = 0
+        self.ytdh  = collections.defaultdict(zero)
+        self.ytds  = collections.defaultdict(zero)
+        self.reimb = collections.defaultdict(decimal.Decimal)
+        self.tax   = collections.defaultdict(decimal.Decimal)
+        self.quarters = collections.defaultdict(decimal.Decimal)
+
+    def replay(self, rates):
+        # YTD gross is always figured at the current rates, the hours are walked again when they change
+        self.rates = rates
+        self.hidx  = 0
+        self.ytdh  = collections.defaultdict(self.zero)
+        self.ytds  = collections.defaultdict(self.zero)
+        self.ytds['SickAccum'] = 0
+
+    def copy(self):
+        ret = Ledger(self.zero)
+        ret.scale, ret.rates, ret.hidx, ret.ridx = self.scale, self.rates, self.hidx, self.ridx
+        for name in self.TOTALS:
+            values = getattr(self, name)
+            setattr(ret, name, collections.defaultdict(values.default_factory, values))
+        return ret
+
+
+def _since(dates, ordered, start, stop):
+    # indexes before stop dated start or later, a bisect when the dates are in order
+    if ordered:
+        return range(bisect.bisect_left(dates, start, 0, stop), stop)
+    return [idx for idx in range(stop) if dates[idx] >= start]
+
+
+def nanny_calculate(sconfig, periods, taxtables, nanny, ndata, fixed=False):
+    return nanny_ledger(sconfig, periods, taxtables, nanny, ndata, fixed=fixed)[0]
+
+
+def nanny_ledger(sconfig, periods, taxtables, nanny, ndata, resume=None, fixed=False):
+    # resume is (count, results, ledger) when the first count periods are already final, the sweep carries on
+    # after them.  Returns the results for all periods and a ledger copy for each newly calculated period.
+    # fixed selects the integer FixedRows engine for the hours, the results are the same either way down to the exponents.
+
+    rows    = (FixedRows if fixed else DecimalRows)(sconfig, nanny, ndata.hours)
+    count, done, ledger = resume or (0, dict(), Ledger(rows.zero))
+    ret     = dict(done)
+    ledger  = ledger.copy()
+    ledgers = list()
+    if ledger.scale != rows.scale:
+        # running hours kept at another fixed point scale (a later row added decimal places) are walked again
+        ledger.replay(ledger.rates)
+        ledger.scale = rows.scale
+    todo    = periods[count:]
+    hdates  = ndata.hours.dates
+    rdates  = [r.date for r in ndata.reimbursements]
+    hsorted = ndata.hours.ordered
+    rsorted = all(a <= b for a, b in zip(rdates, rdates[1:]))
+
+    # One forward sweep over hours and reimbursements, the running YTD totals are copied out at each period end
+    for period in todo:
         start = period.startDate()
         end   = period.endDate()
-        rates = period.rates(nanny)
 
-        ret[end] = dict()
-        p = ret[end]['hours'] = collections.defaultdict(decimal.Decimal)
-        s = ret[end]['sums'] = collections.defaultdict(decimal.Decimal)
+        if period.rates(nanny) != ledger.rates:
+            ledger.replay(period.rates(nanny))
+        rates, ytdh, ytds, reimb = ledger.rates, ledger.ytdh, ledger.ytds, ledger.reimb
 
-        s['SickAccum'] = 0
+        ph = collections.defaultdict(rows.zero)
+        ps = collections.defaultdict(rows.zero)
 
-        for h in ndata.hours:
-            if h.date > end: break  # don't go past this period
-            s['SickAccum'] += h.hours('Sick Adjust')
+        # rows already in the YTD totals that are also part of this period (overlapping periods)
+        prows = list(_since(hdates, hsorted, start, ledger.hidx))
+        for idx in prows:
+            for hrkey, hrs, gross, dkeys in rows.calc(rates, idx):
+                for dkey in dkeys:
+                    ph[dkey] += hrs
+                    ps[dkey] += gross
 
-            for hrkey, ratefunc, dkeys in calcs:
-                hrs, gross = ratefunc(h.hours(hrkey), rates)
+        while ledger.hidx < len(hdates) and hdates[ledger.hidx] <= end:  # don't go past this period
+            idx = ledger.hidx
+            ledger.hidx += 1
+            inperiod = hdates[idx] >= start
+            if inperiod: prows.append(idx)
+            ytds['SickAccum'] += rows.adjust(idx)
 
+            for hrkey, hrs, gross, dkeys in rows.calc(rates, idx):
                 if hrkey not in ('Sick', 'Holiday'):
-                    s['SickAccum'] += sconfig.sickaccum(nanny, hrs)
+                    ytds['SickAccum'] += rows.accrue(hrs, hrkey, idx)
                 elif hrkey == 'Sick':
-                    s['SickAccum'] -= hrs
+                    ytds['SickAccum'] -= rows.sick(hrs, idx)
 
                 for dkey in dkeys:
                     # YTD inclusive
-                    p[dkey + ' YTD'] += hrs
-                    s[dkey + ' YTD'] += gross
+                    ytdh[dkey + ' YTD'] += hrs
+                    ytds[dkey + ' YTD'] += gross
 
                     # This period
-                    if h.date >= start:
-                        p[dkey] += hrs
-                        s[dkey] += gross
+                    if inperiod:
+                        ph[dkey] += hrs
+                        ps[dkey] += gross
+
+        ret[end] = dict()
+        p = ret[end]['hours'] = collections.defaultdict(decimal.Decimal, rows.hoursout(ph, prows))
+        s = ret[end]['sums'] = collections.defaultdict(decimal.Decimal, rows.sumsout(ps))
+
+        for idx in _since(rdates, rsorted, start, ledger.ridx):
+            r = ndata.reimbursements[idx]
+            for child in sconfig.children:
+                s[child+' Reimbursements'] += r.amount/2
 
-        for r in ndata.reimbursements:
-            if r.date > end: break
+        while ledger.ridx < len(rdates) and rdates[ledger.ridx] <= end:
+            r = ndata.reimbursements[ledger.ridx]
+            ledger.ridx += 1
             # Full YTD calculations
             for child in sconfig.children:
-                s[child+' Reimbursements YTD'] += r.amount/2
+                reimb[child+' Reimbursements YTD'] += r.amount/2
 
             if r.date < start: continue
             for child in sconfig.children:
                 s[child+' Reimbursements'] += r.amount/2
 
+        p.update(rows.ytdhoursout(ytdh, ledger.hidx))
+        s.update(rows.sumsout(ytds, ledger.hidx))
+        s.update(reimb)
         for child in sconfig.children:
             for key in (child+' Reimbursements', child+' Reimbursements YTD'):
                 s[key] = s[key].quantize(CENTS, rounding=decimal.ROUND_UP)
 
+        ledgers.append(ledger.copy())
+
 
     ## Taxes and net
-    ytd = collections.defaultdict(decimal.Decimal)
-    for period in periods:
-        start = period.startDate()
-        end   = period.endDate()
-        rates = period.rates(nanny)
+    ytd    = ledger.tax
+    qtd    = ledger.quarters
+    totals = [sum((ret[period.endDate()]['sums'][child+' Gross'] for child in sconfig.children), decimal.Decimal(0)) for period in todo]
+    feds   = taxtables.getTaxMany([period.withholding(nanny) for period in todo], totals)  # fed is calculated as 1 and then divided between employers
 
-        sums = ret[end]
-        w4   = period.withholding(nanny)
+    for period, totalgross, fed, snapshot in zip(todo, totals, feds, ledgers):
+        sums = ret[period.endDate()]
         s    = sums['sums']
         t    = sums['tax'] = collections.defaultdict(decimal.Decimal)
         n    = sums['net'] = collections.defaultdict(decimal.Decimal)
-
-        totalgross = decimal.Decimal(0)
-        for child in sconfig.children:
-            totalgross += s[child+' Gross']
-        fed = taxtables.getTax(w4, totalgross)  # fed is calculated as 1 and then divided between employers
+        qtr  = period.quarter()
 
         for child in sconfig.children:
             childytdgross = s[child+' Gross YTD']
@@ -148,10 +386,29 @@ def nanny_calculate(sconfig, periods, taxtables, nanny, ndata):
             for copy in ('Fed', 'SS1', 'SS2', 'Medicare1', 'Medicare2', 'WALeave', 'WAUnemp', 'FedUnemp', 'EmployeeTax', 'EmployerTax'):
                 t['{} {} YTD'.format(child, copy)] = ytd['{} {}'.format(child, copy)]
 
+            # quarters by pay date for the WA reports
+            qkey = '{} Q{} '.format(child, qtr)
+            qtd[qkey+'Hours']   += sums['hours'].get(child+' Gross', 0)
+            qtd[qkey+'Wages']   += childgross
+            qtd[qkey+'WALeave'] += waleave
+            qtd[qkey+'WAUnemp'] += waunemp
+
         for child in sconfig.children:
             ncalc = [(child, child+' ', ''), (child+' YTD', child+' ', ' YTD')]
             for dest, prefix, suffix in ncalc:
                 n[dest] = (sums['sums'][prefix+'Gross'+suffix] - sums['tax'][prefix+'EmployeeTax'+suffix] + sums['sums'][prefix+'Reimbursements'+suffix]).quantize(CENTS, rounding=decimal.ROUND_UP)
 
-    return ret
+        # Rollups to date, the quarters so far and the year for the W-2 and Schedule H
+        r = sums['rollup'] = collections.defaultdict(decimal.Decimal, qtd)
+        for child in sconfig.children:
+            r[child+' Year Hours']     = sums['hours'].get(child+' Gross YTD', 0)
+            r[child+' Year Wages']     = s[child+' Gross YTD']
+            r[child+' Year FUTAWages'] = min(s[child+' Gross YTD'], sconfig.fed_unemployment_base)
+            for key, total in (('Fed', 'Fed'), ('SS', 'SS1'), ('Medicare', 'Medicare1'), ('WALeave', 'WALeave'), ('WAUnemp', 'WAUnemp')):
+                r['{} Year {}'.format(child, key)] = ytd['{} {}'.format(child, total)]
+
+        snapshot.tax = collections.defaultdict(decimal.Decimal, ytd)
+        snapshot.quarters = collections.defaultdict(decimal.Decimal, qtd)
+
+    return ret, ledgers
 
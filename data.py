@@ -1,19 +1,46 @@
 
+import array
 import bisect
 import collections
+import collections.abc
+import datetime
 import dateutil.parser
 import decimal
-import logging
+from functools import partial
 import json
+import logging
 import os
+import re
+import stat
+import tempfile
+import threading
+import time
 import types
 
 from flask import current_app, g
+import google.auth.exceptions
 from google.oauth2 import service_account
+import google_auth_httplib2
 import googleapiclient.discovery
+import googleapiclient.errors
+import googleapiclient.http
+import httplib2
+
+import snapshot
+from timing import phase
 
 secretfile  = os.path.join(os.getcwd(), 'creds.json')
-credentials = service_account.Credentials.from_service_account_file(secretfile, scopes=['https://www.googleapis.com/auth/spreadsheets.readonly'])
+scopes      = ['https://www.googleapis.com/auth/spreadsheets.readonly', 'https://www.googleapis.com/auth/drive.metadata.readonly']
+credentials = None
+credlock    = threading.Lock()
+
+def get_credentials():
+    # read on first use instead of at import, a cold start doesn't wait on creds.json until it needs the API
+    global credentials
+    with credlock:
+        if credentials is None:
+            credentials = service_account.Credentials.from_service_account_file(secretfile, scopes=scopes)
+        return credentials
 
 
 DEC0 = decimal.Decimal(0)
@@ -27,6 +54,17 @@ def str2dec(val):
     return ret
 
 
+def str2date(val):
+    # sheet dates are m/d/yyyy, anything else goes through dateutil
+    try:
+        month, day, year = val.split('/')
+        if len(year.strip()) == 4:
+            return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        pass
+    return dateutil.parser.parse(val).date()
+
+
 class Config():
     def __init__(self, sheet):
         self.lists = dict(nanny=dict(), child=dict(), childfullname=dict(), employer=dict(), sickaccum=dict())
@@ -49,13 +87,20 @@ class Config():
                 val = str2dec(r[1])
                 setattr(self, name, val)
 
+        # reverse lookups so the per row calls in the calc don't scan the lists, first entry wins like next() did
+        self.nannyindex = dict()
+        self.childindex = dict()
+        for k, v in self.lists['nanny'].items(): self.nannyindex.setdefault(v[0], k)
+        for k, v in self.lists['child'].items(): self.childindex.setdefault(v, k)
+        self.hoursper   = {n: self.lists['sickaccum'][k] for n, k in self.nannyindex.items() if k in self.lists['sickaccum']}
+        self.employers  = {c: self.lists['employer'][k]  for c, k in self.childindex.items() if k in self.lists['employer']}
 
     @property
     def nannies(self):
         return [x[0] for x in self.lists['nanny'].values()]
 
     def nannyidx(self, nanny):
-        return next(k for k,v in self.lists['nanny'].items() if v[0] == nanny)
+        return self.nannyindex[nanny]
 
     def address(self, nanny):
         return self.lists['nanny'][self.nannyidx(nanny)][1:-1]
@@ -64,7 +109,7 @@ class Config():
         return self.lists['nanny'][self.nannyidx(nanny)][-1]
 
     def sickaccum(self, nanny, hours):
-        hoursper = self.lists['sickaccum'][self.nannyidx(nanny)]
+        hoursper = self.hoursper[nanny]
         if hoursper:  return hours/hoursper
         return 0
 
@@ -78,10 +123,10 @@ class Config():
         return self.lists['child'].values()
 
     def childidx(self, child):
-        return next(k for k,v in self.lists['child'].items() if v == child)
+        return self.childindex[child]
 
     def employer(self, child):
-        return self.lists['employer'][self.childidx(child)]
+        return self.employers[child]
 
     def ein(self, child):
         return self.employer(child).split()[-1]
@@ -95,10 +140,14 @@ class PayPeriod():
         self.data = dict()
         for name, val in zip(header, data):
             self.data[name] = val
-
-    def startDate(self):         return dateutil.parser.parse(self.data['Start'])
-    def endDate(self):           return dateutil.parser.parse(self.data['End'])
-    def payDate(self):           return dateutil.parser.parse(self.data['PayDate'])
+        self.start   = str2date(self.data['Start'])
+        self.end     = str2date(self.data['End'])
+        self.paydate = str2date(self.data['PayDate'])
+
+    def startDate(self):         return self.start
+    def endDate(self):           return self.end
+    def payDate(self):           return self.paydate
+    def quarter(self):           return (self.paydate.month - 1) // 3 + 1
     def rates(self, name):       return list(map(str2dec, map(str.strip, self.data['{} Rates'.format(name)].split(','))))
     def withholding(self, name): return list(map(int, map(str.strip, self.data['{} Withholding'.format(name)].split(','))))
     def __repr__(self):          return str(self.__dict__)
@@ -132,108 +181,467 @@ class TaxTablesPre20():
 
         return allowances[bisect.bisect_left(amounts, gross)-1][w4[1]] + w4[2]
 
+    def getTaxMany(self, w4s, grosses):
+        return [self.getTax(w4, gross) for w4, gross in zip(w4s, grosses)]
+
 
 class TaxTablesPost20():
-    W4COLS = ['1c', '2c', '3', '4a', '4b', '4c']
+    W4COLS    = ['1c', '2c', '3', '4a', '4b', '4c']
+    PERIODS   = 26
+    INDICATOR = re.compile(r'w4\[([01])\]\s*=\s*(\d+)')
 
     def __init__(self, taxtables):
-        self.tables = collections.defaultdict(list)
+        rows = collections.defaultdict(list)
         w4 = [0,0]
-        for row in taxtables['values']:
-            if len(row) == 1 and len(row[0].strip()) == 7: # our table indicator
-                exec(row[0].strip())
+        for num, row in enumerate(taxtables['values'], 1):
+            if not any(cell.strip() for cell in row):
+                continue
+            elif len(row) == 1: # our table indicator, e.g. w4[0]=1
+                match = self.INDICATOR.fullmatch(row[0].strip())
+                if not match:
+                    raise ValueError("Tax Tables row {}: invalid table indicator {!r}".format(num, row[0]))
+                w4[int(match.group(1))] = int(match.group(2))
             elif len(row) == 5:
-                self.tables[tuple(w4)].append(row)
+                try:
+                    rows[tuple(w4)].append(tuple(map(str2dec, row)))
+                except decimal.InvalidOperation:
+                    raise ValueError("Tax Tables row {}: invalid bracket {}".format(num, row)) from None
             else:
-                log.warning("invalid row {}".format(row))
-
+                raise ValueError("Tax Tables row {}: expected a table indicator or 5 bracket columns, got {}".format(num, row))
+
+        self.tables = {key: self.compile(brackets) for key, brackets in rows.items()}
+
+    @staticmethod
+    def compile(brackets):
+        # (starts, brackets, standard), bisect over starts needs non-overlapping brackets with one standard deduction
+        ordered  = sorted(brackets)
+        standard = ordered[0][4]
+        if any(b[4] != standard for b in ordered) or any(lo[1] > hi[0] for lo, hi in zip(ordered, ordered[1:])):
+            return None, brackets, None
+        return [b[0] for b in ordered], ordered, standard
+
+    def withhold(self, w4c, adjannwage, bracket):
+        (start, end, base, rate, standard) = bracket
+        basetax  = decimal.Decimal((((adjannwage - start) * rate) + base) / self.PERIODS)
+        credits  = decimal.Decimal(w4c['3'] / self.PERIODS)
+        withhold = max(basetax - credits, 0) + w4c['4c']
+        return withhold.quantize(decimal.Decimal('0.01'))
 
     def getTax(self, w4, gross):
-        w4c     = {x:w4[ii] for ii, x in enumerate(self.W4COLS)}
-        table   = self.tables[(w4c['1c'], w4c['2c'])]
-        periods = 26
-        annual  = (gross * periods) + w4c['4a']
-
-        for row in table:
-            (start, end, base, bracket, standard) = list(map(str2dec, row))
-            deductions = w4c['4b'] + standard
-            adjannwage = max(annual - deductions, 0)
-
-            if start <= adjannwage < end:
-                basetax  = decimal.Decimal((((adjannwage - start) * bracket) + base) / periods)
-                credits  = decimal.Decimal(w4c['3'] / periods)
-                withhold = max(basetax - credits, 0) + w4c['4c']
-                return withhold.quantize(decimal.Decimal('0.01'))
+        w4c      = {x:w4[ii] for ii, x in enumerate(self.W4COLS)}
+        starts, brackets, standard = self.tables.get((w4c['1c'], w4c['2c']), ([], [], DEC0))
+        annual   = (gross * self.PERIODS) + w4c['4a']
+
+        if starts is None:
+            for bracket in brackets:
+                adjannwage = max(annual - (w4c['4b'] + bracket[4]), 0)
+                if bracket[0] <= adjannwage < bracket[1]:
+                    return self.withhold(w4c, adjannwage, bracket)
+            return 0
+
+        adjannwage = max(annual - (w4c['4b'] + standard), 0)
+        ii = bisect.bisect_right(starts, adjannwage) - 1
+        if ii >= 0 and adjannwage < brackets[ii][1]:
+            return self.withhold(w4c, adjannwage, brackets[ii])
         return 0
 
+    def getTaxMany(self, w4s, grosses):
+        return [self.getTax(w4, gross) for w4, gross in zip(w4s, grosses)]
+
 
 class Hours():
-    def __init__(self, header, row):
-        self.data = dict()
-        for name, val in zip(header, row):
-            if name == 'Day':
-                pass
-            elif name == 'Date':
-                self.date = dateutil.parser.parse(val)
-            else:
-                self.data[name] = val and str2dec(val) or DEC0
+    # row view into an HoursTable
+    __slots__ = ('table', 'idx')
 
-    def date(self): return self.date
-    def hours(self, name): return self.data.get(name, DEC0)
-    def __repr__(self): return str(self.__dict__)
+    def __init__(self, table, idx):
+        self.table = table
+        self.idx   = idx
+
+    @property
+    def date(self): return self.table.dates[self.idx]
+    @property
+    def data(self): return HoursData(self)
+    def hours(self, name): return self.table.hours(name, self.idx)
+    def __repr__(self): return str(dict(date=self.date, data=self.data))
 
     @classmethod
     def parseSheet(cls, sheet):
-        return [ cls(sheet['values'][1], r) for r in sheet['values'][2:] ]
+        return HoursTable(sheet['values'][1], sheet['values'][2:])
+
+
+class HoursData(collections.abc.Mapping):
+    # read only name -> hours of one row, each lookup only converts the column it asks for
+    __slots__ = ('hrs',)
+
+    def __init__(self, hrs):
+        self.hrs = hrs
+
+    def __getitem__(self, name):
+        if name not in self.hrs.table.index:
+            raise KeyError(name)
+        return self.hrs.hours(name)
+
+    def __iter__(self):
+        return iter(self.hrs.table.names)
+
+    def __len__(self):
+        return len(self.hrs.table.names)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class HoursTable():
+    # Hours stored by column, each column is an array of fixed point integers with its own exponent
+    # (at least thousandths of an hour) so every sheet value is held exactly, plus a map back to Decimal.
+    # Only the dates are parsed up front, a column is converted from the raw rows the first time it is
+    # used.  Columns are stored with a single dict assignment so threads sharing a cached table at worst
+    # convert one twice.
+
+    def __init__(self, header, rows):
+        self.rows    = list()
+        self.dates   = list()
+        self.index   = {name: ci for ci, name in enumerate(header) if name not in ('Day', 'Date')}
+        self.names   = list(self.index)
+        self.columns = dict()
+
+        # lines without a date or any hours are dropped from the rows and dates together so the columns stay aligned
+        di = header.index('Date')
+        for num, row in enumerate(rows, 3):
+            if len(row) > di and row[di].strip():
+                self.rows.append(row)
+                self.dates.append(str2date(row[di]))
+            elif any(row[ci].strip() for ci in self.index.values() if ci < len(row)):
+                raise ValueError("Hours row {}: hours without a date {}".format(num, row))
+        self.ordered = all(a <= b for a, b in zip(self.dates, self.dates[1:]))
+
+    def column(self, name):
+        # (array of ints, int -> Decimal map, exponent) or None when the sheet has no such column
+        ret = self.columns.get(name)
+        if ret is None and name in self.index:
+            ci      = self.index[name]
+            column  = [ci < len(row) and row[ci] and str2dec(row[ci]) or DEC0 for row in self.rows]
+            decoded = {v: None for v in column}
+            exp     = min([-3] + [v.as_tuple().exponent for v in decoded])
+            decoded = {int(v.scaleb(-exp)): v for v in decoded}
+            encoded = {v: k for k, v in decoded.items()}
+            ret = self.columns[name] = (array.array('q', map(encoded.__getitem__, column)), decoded, exp)
+        return ret
+
+    def row(self, idx):
+        # the sheet row as fetched
+        return self.rows[idx]
+
+    def hours(self, name, idx):
+        column = self.columns.get(name) or self.column(name)
+        if column is None:
+            return DEC0
+        return column[1][column[0][idx]]
+
+    def digits(self, names):
+        # decimal places needed to hold the named columns exactly
+        return max([3] + [-self.column(name)[2] for name in names if name in self.index])
+
+    def scaled(self, name, digits):
+        # the column as plain ints in units of 10**-digits, digits has to be at least the column's own
+        column = self.column(name)
+        if column is None:
+            return [0] * len(self)
+        mult = 10 ** (digits + column[2])
+        return [v * mult for v in column[0]]
+
+    def between(self, start, end):
+        if not self.ordered:
+            return [h for h in self if start <= h.date <= end]
+        return self[bisect.bisect_left(self.dates, start):bisect.bisect_right(self.dates, end)]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [Hours(self, ii) for ii in range(*idx.indices(len(self)))]
+        return Hours(self, range(len(self))[idx])
+
+    def __iter__(self):
+        return (Hours(self, ii) for ii in range(len(self)))
 
 
 class Reimbursement():
+    # date and amount are parsed for the calc, the notes are only looked up when a paystub shows them
+    __slots__ = ('date', 'amount', 'header', 'row')
+
     def __init__(self, header, row):
+        self.header = header
+        self.row    = row
         for name, val in zip(header, row):
-            if name == 'Date': self.date = dateutil.parser.parse(val)
+            if name == 'Date': self.date = str2date(val)
             elif name == 'Amount': self.amount = str2dec(val)
-            elif name == 'Notes': self.notes = val
-    def __repr__(self): return str(self.__dict__)
+
+    @property
+    def notes(self):
+        for name, val in zip(self.header, self.row):
+            if name == 'Notes': return val
+        raise AttributeError('notes')
+
+    def __repr__(self): return str(dict(date=getattr(self, 'date', None), amount=getattr(self, 'amount', None), notes=getattr(self, 'notes', None)))
 
     @classmethod
     def parseSheet(cls, sheet):
         return [ cls(sheet['values'][1], r) for r in sheet['values'][2:] ]
 
 
-def _get_api():
-    if not hasattr(g, 'api'):
-        service = googleapiclient.discovery.build('sheets', 'v4', credentials=credentials)
-        g.api   = service.spreadsheets()
-    return g.api
+# Process wide LRU cache of parsed sheet ranges.  Entries older than the ttl are only refetched
+# if the spreadsheet revision has moved since they were loaded.
+class SheetCache():
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.lock    = threading.Lock()
+        self.hits    = 0
+        self.misses  = 0
+
+    def get(self, key, ttl, revision):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            stamp, rev, value = entry
+            fresh = time.monotonic() - stamp <= ttl
+            if not fresh and rev is not None and rev == revision():
+                fresh = True
+                stamp = time.monotonic()  # sheet unchanged, good for another ttl
+            if fresh:
+                with self.lock:
+                    if self.entries.get(key) is entry:
+                        self.entries[key] = (stamp, rev, value)
+                        self.entries.move_to_end(key)
+                    self.hits += 1
+                return value
+        with self.lock:
+            if self.entries.get(key) is entry:
+                self.entries.pop(key, None)
+            self.misses += 1
+        return None
+
+    def put(self, key, value, revision, maxsize):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), revision, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > maxsize:
+                self.entries.popitem(last=False)
+
+    def age(self, key):
+        # seconds since the entry was fetched or last confirmed current, None if not cached
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry and time.monotonic() - entry[0]
+
+    def invalidate(self, sheetid=None):
+        with self.lock:
+            for key in [k for k in self.entries if sheetid is None or k[0] == sheetid]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            oldest = max([time.monotonic() - e[0] for e in self.entries.values()], default=None)
+            return dict(entries=len(self.entries), hits=self.hits, misses=self.misses, oldest=oldest)
+
+sheetcache = SheetCache()
+
+
+def _snapshot_backend():
+    return current_app.config.get('SHEETS_BACKEND', 'google') == 'snapshot'
+
+
+# One client per API for the whole process.  The discovery document is read once (from DISCOVERY_DIR when
+# bundled with the app, else fetched and kept in a private temp dir), and since httplib2 connections can't be
+# shared between threads every thread sends its requests over its own authorized keep-alive connections.
+_clients    = dict()
+_clientlock = threading.Lock()
+_local      = threading.local()
+
+def _thread_http():
+    if not hasattr(_local, 'http'):
+        _local.http = google_auth_httplib2.AuthorizedHttp(get_credentials(), http=googleapiclient.http.build_http())
+    return _local.http
+
+
+def _thread_request(http, *args, **kwargs):
+    # requestBuilder for the shared clients, the request goes out on the calling thread's connections
+    return googleapiclient.http.HttpRequest(_thread_http(), *args, **kwargs)
+
+
+def private_dir():
+    # <temp dir>/nanny-reports-<uid>, created 0700 and only used while it is still a directory of ours that no one
+    # else can get into, for files that are read back and trusted
+    path = os.path.join(tempfile.gettempdir(), 'nanny-reports-{}'.format(os.getuid()))
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError("{} is not a private directory".format(path))
+    return path
+
+
+GOOGLEAPIS = re.compile(r'https://([a-z0-9-]+\.)*googleapis\.com/')
+
+def _trusted_document(content):
+    # a discovery document only sends requests (and the credentials' token) to a googleapis.com host
+    try:
+        doc = json.loads(content)
+    except ValueError:
+        return False
+    return all(isinstance(doc.get(k), str) and GOOGLEAPIS.match(doc[k]) for k in ('rootUrl', 'baseUrl'))
+
+
+def _discovery_document(name, version):
+    filename = '{}.{}.json'.format(name, version)
+    bundled  = os.path.join(current_app.config.get('DISCOVERY_DIR', 'discovery'), filename)
+    if os.path.isfile(bundled):
+        with open(bundled, 'r') as fp:
+            content = fp.read()
+        if _trusted_document(content):
+            return content
+        log.warning("ignoring discovery document {} for a host outside googleapis.com".format(bundled))
+
+    try:
+        cached = os.path.join(private_dir(), 'discovery-' + filename)
+    except OSError as e:
+        log.warning("not caching discovery documents: {}".format(e))
+        cached = None
+    if cached and os.path.isfile(cached) and time.time() - os.path.getmtime(cached) < current_app.config.get('DISCOVERY_MAX_AGE', 86400):
+        with open(cached, 'r') as fp:
+            content = fp.read()
+        if _trusted_document(content):
+            return content
+
+    http = googleapiclient.http.build_http()
+    for template in (googleapiclient.discovery.DISCOVERY_URI, googleapiclient.discovery.V2_DISCOVERY_URI):
+        uri = template.format(api=name, apiVersion=version)
+        resp, content = http.request(uri)
+        if resp.status == 200:
+            break
+    else:
+        raise googleapiclient.errors.HttpError(resp, content, uri=uri)
+    content = content.decode()
+    if not _trusted_document(content):
+        raise googleapiclient.errors.InvalidJsonError("discovery document from {} is not for googleapis.com".format(uri))
+
+    if cached:
+        try:
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(cached))
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(content)
+            os.replace(tmpfile, cached)
+        except OSError as e:
+            log.warning("unable to cache discovery document {}: {}".format(cached, e))
+    return content
+
+
+def _get_client(name, version, resource):
+    with _clientlock:
+        if name not in _clients:
+            service = googleapiclient.discovery.build_from_document(_discovery_document(name, version), http=_thread_http(), requestBuilder=_thread_request)
+            _clients[name] = getattr(service, resource)()
+        return _clients[name]
 
 
-def _get_data(testfile, ranges):
-    if current_app.config['ENV'] == 'development' and os.path.isfile(testfile):
-        with open(testfile, 'r') as fp:
-            data = json.load(fp)
-    else:
-        data = _get_api().values().batchGet(spreadsheetId=current_app.config['SPREADSHEET_ID_{}'.format(g.year)], ranges=ranges).execute()
-        if current_app.config['ENV'] == 'development':
-            with open(testfile, 'w') as fp:
-                json.dump(data, fp)
-    return data
+def _get_api():
+    # SHEETS_BACKEND = 'snapshot' serves batchGet from SNAPSHOT_DIR, optionally delayed by SNAPSHOT_LATENCY seconds
+    if _snapshot_backend():
+        if not hasattr(g, 'api'):
+            lookup = snapshot.SnapshotDir(current_app.config['SNAPSHOT_DIR'], current_app.config.get('SNAPSHOT_VERSION'))
+            g.api  = snapshot.FakeSheets(lookup, current_app.config.get('SNAPSHOT_LATENCY', 0))
+        return g.api
+    return _get_client('sheets', 'v4', 'spreadsheets')
+
+
+def _get_drive():
+    return _get_client('drive', 'v3', 'files')
+
+
+# API, auth and transport failures (socket errors are OSErrors) from the Drive call or from building its client
+REVISION_ERRORS = (googleapiclient.errors.Error, google.auth.exceptions.GoogleAuthError, httplib2.HttpLib2Error, OSError, ValueError, KeyError)
+
+def _get_revision(sheetid):
+    # Drive modifiedTime moves on every edit and is far cheaper than pulling the ranges again
+    if not current_app.config.get('SHEETS_REVISION_CHECK', True):
+        return None
+    if not hasattr(g, 'revisions'):
+        g.revisions = dict()
+    if sheetid not in g.revisions:
+        if _snapshot_backend():
+            g.revisions[sheetid] = snapshot.latest(current_app.config['SNAPSHOT_DIR'], sheetid, current_app.config.get('SNAPSHOT_VERSION'))
+            return g.revisions[sheetid]
+        try:
+            with phase('fetch'):  # it runs in sheetcache.get, before _get_data's own fetch phase
+                g.revisions[sheetid] = _get_drive().get(fileId=sheetid, fields='modifiedTime').execute()['modifiedTime']
+        except REVISION_ERRORS as e:
+            # no revision means the ranges are fetched again, a failed lookup never fails the request
+            log.warning("unable to get revision of {}: {!r}".format(sheetid, e))
+            g.revisions[sheetid] = None
+    return g.revisions[sheetid]
+
+
+def _get_data(ranges, parser):
+    sheetid  = current_app.config['SPREADSHEET_ID_{}'.format(g.year)]
+    key      = (sheetid, g.year, tuple(ranges))
+    revision = partial(_get_revision, sheetid)
+    ttl      = 0 if g.get('refresh') else current_app.config.get('SHEETS_CACHE_TTL', 300)  # refresh revalidates now
+    parsed   = sheetcache.get(key, ttl, revision)
+    if parsed is None:
+        with phase('fetch'):
+            rev  = revision()  # before the fetch so an edit during the fetch is seen next time
+            data = _get_api().values().batchGet(spreadsheetId=sheetid, ranges=ranges).execute()
+        if current_app.config.get('SNAPSHOT_RECORD') and not _snapshot_backend():
+            # one snapshot version per sheet revision, or per day without revision checks
+            version = (rev or time.strftime('%Y-%m-%d')).replace(':', '')
+            snapshot.save(current_app.config['SNAPSHOT_DIR'], sheetid, version, ranges, data)
+        with phase('parse'):
+            parsed = parser(data)
+        sheetcache.put(key, parsed, rev, current_app.config.get('SHEETS_CACHE_SIZE', 64))
+    g.dataage = max(g.get('dataage', 0), sheetcache.age(key) or 0)
+    return parsed
 
 
 def get_config_data():
-    config = _get_data('{}_config.json'.format(g.year), ['Config', 'PayPeriods'])
-    return Config(config['valueRanges'][0]), PayPeriod.parseSheet(config['valueRanges'][1])
+    return _get_data(['Config', 'PayPeriods'],
+                lambda d: (Config(d['valueRanges'][0]), PayPeriod.parseSheet(d['valueRanges'][1])))
 
 
-def get_tax_data():
+def _tax_ranges():
     if g.year <= 2019:
-        tax = _get_data('{}_tax.json'.format(g.year), ['Single Bracket', 'Married Bracket'])
-        return TaxTablesPre20(*tax['valueRanges'])
-    else:
-        tax = _get_data('{}_tax.json'.format(g.year), ['Tax Tables'])
-        return TaxTablesPost20(*tax['valueRanges'])
+        return ['Single Bracket', 'Married Bracket']
+    return ['Tax Tables']
+
+
+def _tax_tables(valueranges):
+    if g.year <= 2019:
+        return TaxTablesPre20(*valueranges)
+    return TaxTablesPost20(*valueranges)
+
+
+def _nanny_ranges(name):
+    return ['{} Hours'.format(name), '{} Reimbursements'.format(name)]
+
+
+def _nanny_data(hours, reimbursements):
+    return types.SimpleNamespace(hours = Hours.parseSheet(hours), reimbursements = Reimbursement.parseSheet(reimbursements))
+
+
+def get_tax_data():
+    return _get_data(_tax_ranges(), lambda d: _tax_tables(d['valueRanges']))
 
 
 def get_nanny_data(name):
-    data = _get_data('{}_{}.json'.format(g.year, name.replace(' ','_')), ['{} Hours'.format(name), '{} Reimbursements'.format(name)])
-    return types.SimpleNamespace(hours = Hours.parseSheet(data['valueRanges'][0]), reimbursements = Reimbursement.parseSheet(data['valueRanges'][1]))
+    return _get_data(_nanny_ranges(name), lambda d: _nanny_data(*d['valueRanges']))
+
+
+def get_all_nanny_data(names):
+    # tax tables and every nanny's ranges in one batchGet, returns the tax tables and a dict of nanny data by name
+    taxranges = _tax_ranges()
+    ranges    = taxranges + [r for name in names for r in _nanny_ranges(name)]
+
+    def parser(data):
+        tax, rest = data['valueRanges'][:len(taxranges)], data['valueRanges'][len(taxranges):]
+        return _tax_tables(tax), {name: _nanny_data(*rest[ii*2:ii*2+2]) for ii, name in enumerate(names)}
 
+    return _get_data(ranges, parser)
@@ -1,20 +1,42 @@
 #!/usr/bin/env python3
 
 import base64
+import concurrent.futures
 from collections import defaultdict
 import csv
 import dateutil.parser
 import decimal
-import io
-import math
 import os
+import zipfile
 
-from flask import g, Flask, redirect, render_template, url_for
+from flask import abort, g, Flask, jsonify, redirect, render_template, request, Response, stream_with_context, url_for
+from flask.helpers import get_debug_flag
 
 from data import *
 from calc import *
+from store import all_nanny_results, nanny_results
+import timing
+import warmup
 
 app = Flask("nanny-reports")
+app.before_request(timing.before_request)
+app.after_request(timing.after_request)
+app.teardown_request(timing.teardown_request)
+
+@app.before_first_request
+def prefetch():
+    warmup.start(app)
+
+@app.after_request
+def dataage(response):
+    # how long ago the oldest sheet data used for the response was fetched or confirmed current
+    if g.get('dataage') is not None:
+        response.headers['X-Data-Age'] = '{:.0f}'.format(g.dataage)
+    return response
+
+def render(template, **context):
+    with timing.phase('render'):
+        return render_template(template, **context)
 
 @app.url_value_preprocessor
 def preprocessor(endpoint, values):
@@ -31,108 +53,223 @@ def yearselect():
     years = [x[-4:] for x in current_app.config.keys() if x.startswith('SPREADSHEET')]
     if len(years) == 1:
         return redirect(url_for('.index', year=years[0]))
-    return render_template("year.html", years=years)
+    return render("year.html", years=years)
 
 @app.route('/<int:year>')
 def index():
     sconfig, periods = get_config_data()
-    return render_template("selector.html", sconfig=sconfig, periods=periods)
+    return render("selector.html", sconfig=sconfig, periods=periods)
+
+@app.route('/<int:year>/refresh')
+def refresh():
+    sheetcache.invalidate(current_app.config['SPREADSHEET_ID_{}'.format(g.year)])
+    return redirect(url_for('.index'))
+
+@app.route('/cache')
+def cachestats():
+    return jsonify(sheetcache.stats())
+
+def profile():
+    # registered by common_init in development or with PROFILE_ENABLED set
+    timing.arm_profile()
+    return jsonify(armed=True, dir=timing.profile_dir())
+
+HISTORY = ('Hours', 'Wages', 'Fed', 'SS', 'Medicare', 'WALeave', 'WAUnemp')
+
+def year_history(year):
+    # year totals per nanny and child from the last period's rollup, in its own app context so years can run in threads
+    with app.app_context():
+        g.year = year
+        sconfig, periods = get_config_data()
+        taxtables, nannydata = get_all_nanny_data(sconfig.nannies)
+        ndata = all_nanny_results(sconfig, periods, taxtables, nannydata)
+        lastp = periods[-1].endDate()
+        return {nanny: {child: {key: ndata[nanny][lastp]['rollup']['{} Year {}'.format(child, key)] for key in HISTORY}
+                        for child in sconfig.children} for nanny in sconfig.nannies}
+
+@app.route('/history')
+def history():
+    # Year totals for every configured year, the sheets are fetched concurrently and stored results are reused
+    # so only years whose sheets changed are calculated.  Also the totals across years per nanny and per child.
+    years = sorted(int(x[-4:]) for x in current_app.config.keys() if x.startswith('SPREADSHEET'))
+    with concurrent.futures.ThreadPoolExecutor(max(1, min(len(years), current_app.config.get('HISTORY_THREADS', 4)))) as pool:
+        byyear = dict(zip(years, pool.map(year_history, years)))
+
+    nannies  = defaultdict(lambda: defaultdict(decimal.Decimal))
+    children = defaultdict(lambda: defaultdict(decimal.Decimal))
+    for year, totals in byyear.items():
+        for nanny, bychild in totals.items():
+            for child, values in bychild.items():
+                for key, value in values.items():
+                    nannies[nanny][key]  += value
+                    children[child][key] += value
+
+    tostr = lambda d: {k: tostr(v) if isinstance(v, dict) else str(v) for k, v in d.items()}
+    return jsonify(years=tostr(byyear), nannies=tostr(nannies), children=tostr(children))
 
 @app.route('/<int:year>/tax')
 def tax():
     sconfig, periods = get_config_data()
-    taxtables = get_tax_data()
+    taxtables, nannydata = get_all_nanny_data(sconfig.nannies)
     lastp     = periods[-1].endDate()
     data      = dict()
-    ndata     = dict()
-    for name in sconfig.nannies:
-        ndata[name] = nanny_calculate(sconfig, periods, taxtables, name, get_nanny_data(name))
+    ndata     = all_nanny_results(sconfig, periods, taxtables, nannydata)
 
 
     for child in sconfig.children:
         data[child] = dict()
         data[child]['scheduleH'] = defaultdict(decimal.Decimal)
         for nanny in sconfig.nannies:
+            year = ndata[nanny][lastp]['rollup']
             data[child][nanny] = dict()
-            data[child][nanny]['gross']    = ndata[nanny][lastp]['sums'][child+' Gross YTD']
-            data[child][nanny]['ss']       = ndata[nanny][lastp]['tax'][child+' SS1 YTD']
-            data[child][nanny]['medicare'] = ndata[nanny][lastp]['tax'][child+' Medicare1 YTD']
-            data[child][nanny]['fed']      = ndata[nanny][lastp]['tax'][child+' Fed YTD']
+            data[child][nanny]['gross']    = year[child+' Year Wages']
+            data[child][nanny]['ss']       = year[child+' Year SS']
+            data[child][nanny]['medicare'] = year[child+' Year Medicare']
+            data[child][nanny]['fed']      = year[child+' Year Fed']
 
-            data[child]['scheduleH']['gross']     += ndata[nanny][lastp]['sums'][child+' Gross YTD']
-            data[child]['scheduleH']['futagross'] += min(ndata[nanny][lastp]['sums'][child+' Gross YTD'], sconfig.fed_unemployment_base)
-            data[child]['scheduleH']['fed']       += ndata[nanny][lastp]['tax'][child+' Fed YTD']
-            data[child]['scheduleH']['waunemp']   += ndata[nanny][lastp]['tax'][child+' WAUnemp YTD']
+            data[child]['scheduleH']['gross']     += year[child+' Year Wages']
+            data[child]['scheduleH']['futagross'] += year[child+' Year FUTAWages']
+            data[child]['scheduleH']['fed']       += year[child+' Year Fed']
+            data[child]['scheduleH']['waunemp']   += year[child+' Year WAUnemp']
 
         data[child]['scheduleH']['ss']       = (data[child]['scheduleH']['gross']     * sconfig.social_security).quantize(CENTS)
         data[child]['scheduleH']['medicare'] = (data[child]['scheduleH']['gross']     * sconfig.medicare).quantize(CENTS)
         data[child]['scheduleH']['futa']     = (data[child]['scheduleH']['futagross'] * sconfig.fed_unemployment).quantize(CENTS)
 
 
-    wadata = dict()
-    csvdata = dict()
-    waleave = dict()
-    for child in sconfig.children:
-        wadata[child]  = {ii:{n:dict(hours=0, wages=0, waleave=0) for n in sconfig.nannies} for ii in range(1,5)}
-        csvdata[child] = dict()
+    wadata, waleave = waquarters(sconfig, periods, ndata)
 
-        for period in periods:
-            quarter = math.ceil(period.payDate().month/3)
-            pend    = period.endDate()
-            for nanny in sconfig.nannies:
-                wadata[child][quarter][nanny]['hours']  += ndata[nanny][period.endDate()]['hours'].get(child+' Gross', 0)
-                wadata[child][quarter][nanny]['wages']  += ndata[nanny][period.endDate()]['sums'].get(child+' Gross', 0)
-                wadata[child][quarter][nanny]['waleave'] += ndata[nanny][period.endDate()]['tax'].get(child+' WALeave', 0)
+    return render('tax.html', sconfig=sconfig, data=data, wadata=wadata, waleave=waleave)
 
 
+def waquarters(sconfig, periods, ndata):
+    # per child and quarter, the hours and wages of each nanny paid that quarter and the total WA leave
+    lastp   = periods[-1].endDate()
+    wadata  = dict()
+    waleave = dict()
+    for child in sconfig.children:
+        wadata[child]  = dict()
+        waleave[child] = dict()
         for quarter in range(1,5):
-            # Create the WA quarter reports
-            esdoutput   = io.StringIO()
-            leaveoutput = io.StringIO()
-            esdwriter   = csv.writer(esdoutput,   quoting=csv.QUOTE_ALL)
-            leavewriter = csv.writer(leaveoutput, quoting=csv.QUOTE_ALL)
-
-            # Filter out employees with 0 wages
-            wadata[child][quarter] = {k:v for k,v in wadata[child][quarter].items() if v['wages']}
-
-            for nanny, res in wadata[child][quarter].items():
-                first,last = nanny.split(' ')
-                ssn = sconfig.ssn(nanny)
-                res['hours'] = res['hours'].quantize(INTEG, rounding=decimal.ROUND_UP)
-                res['wages'] = res['wages'].quantize(CENTS)
+            qkey = '{} Q{} '.format(child, quarter)
+            wadata[child][quarter] = dict()
+            for nanny in sconfig.nannies:
+                rollup = ndata[nanny][lastp]['rollup']
+                # Filter out employees with 0 wages
+                if rollup[qkey+'Wages']:
+                    wadata[child][quarter][nanny] = dict(hours   = rollup[qkey+'Hours'].quantize(INTEG, rounding=decimal.ROUND_UP),
+                                                         wages   = rollup[qkey+'Wages'].quantize(CENTS),
+                                                         waleave = rollup[qkey+'WALeave'])
+            waleave[child][quarter] = sum(x['waleave'] for x in wadata[child][quarter].values())
 
-                esdwriter.writerow([ssn, last+','+first,  res['hours'], res['wages']])
-                leavewriter.writerow([ssn, last, first, '', res['hours'], res['wages']])
+    return wadata, waleave
 
-            csvdata[child][quarter] = dict(esd=esdoutput.getvalue(), leave=leaveoutput.getvalue())
 
+class CSVLine():
+    # csv.writer target that hands each formatted row back instead of buffering it
+    def write(self, line):
+        return line
 
-    for child in wadata:
-        waleave[child] = dict()
-        for quarter in wadata[child]:
-            waleave[child][quarter] = sum(x['waleave'] for x in wadata[child][quarter].values())
 
-    return render_template('tax.html', sconfig=sconfig, data=data, wadata=wadata, csvdata=csvdata, waleave=waleave)
+@app.route('/<int:year>/wa/<child>/q<int:quarter>/<report>.csv')
+def wacsv(child, quarter, report):
+    # one quarter's ESD or Paid Leave upload for one employer, streamed a row at a time
+    sconfig, periods = get_config_data()
+    if child not in sconfig.children or quarter not in range(1,5) or report not in ('esd', 'leave'):
+        abort(404)
+    taxtables, nannydata = get_all_nanny_data(sconfig.nannies)
+    wadata, waleave = waquarters(sconfig, periods, all_nanny_results(sconfig, periods, taxtables, nannydata))
+
+    def generate():
+        writer = csv.writer(CSVLine(), quoting=csv.QUOTE_ALL)
+        for nanny, res in wadata[child][quarter].items():
+            first,last = nanny.split(' ')
+            ssn = sconfig.ssn(nanny)
+            if report == 'esd':
+                yield writer.writerow([ssn, last+','+first,  res['hours'], res['wages']])
+            else:
+                yield writer.writerow([ssn, last, first, '', res['hours'], res['wages']])
+
+    filename = '{}-{}-q{}.csv'.format(report, sconfig.ename(child), quarter)
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
+
+
+def stubcontext(period, nanny, ndata, results):
+    return dict(sums    = results[period.endDate()],
+                hours   = ndata.hours.between(period.startDate(), period.endDate()),
+                reimb   = [r for r in ndata.reimbursements if period.startDate() <= r.date <= period.endDate()],
+                period  = period,
+                rates   = period.rates(nanny),
+                nanny   = nanny)
 
 
 @app.route('/<int:year>/paystub/<enddate>/<nannyname>')
 def paystub(enddate, nannyname):
 
-    enddate   = dateutil.parser.parse(enddate.replace('_','/')) 
+    enddate   = dateutil.parser.parse(enddate.replace('_','/')).date()
 
     sconfig, periods = get_config_data()
     taxtables = get_tax_data()
     ndata     = get_nanny_data(nannyname)
-    results   = nanny_calculate(sconfig, periods, taxtables, nannyname, ndata)
+    results   = nanny_results(sconfig, periods, taxtables, nannyname, ndata)
 
     period  = next(p for p in periods if p.endDate() == enddate)
-    hours   = [h for h in ndata.hours if period.startDate() <= h.date <= period.endDate()]
-    reimb   = [r for r in ndata.reimbursements if period.startDate() <= r.date <= period.endDate()]
-    psums   = results[enddate]
-    rates   = period.rates(nannyname)
     children = list(zip(sconfig.children, sconfig.childrenfullname))
 
-    return render_template('paystub.html', sums=psums, hours=hours, reimb=reimb, period=period, rates=rates, sconfig=sconfig, nanny=nannyname, children=children)
+    return render('paystub.html', sconfig=sconfig, children=children, **stubcontext(period, nannyname, ndata, results))
+
+
+class ChunkWriter():
+    # write only file for zipfile to stream into, drained after each member
+    def __init__(self):
+        self.chunks = list()
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        ret = b''.join(self.chunks)
+        self.chunks.clear()
+        return ret
+
+
+@app.route('/<int:year>/paystubs')
+def paystubs():
+    # Every period's stub for each nanny (or just ?nanny=...), results are calculated once per nanny and the
+    # stubs are streamed as they render, as one printable page or with ?format=zip as a zip of pages
+    sconfig, periods = get_config_data()
+    nannies  = [n for n in sconfig.nannies if n in request.args.getlist('nanny')] or sconfig.nannies
+    taxtables, nannydata = get_all_nanny_data(nannies)
+    children = list(zip(sconfig.children, sconfig.childrenfullname))
+
+    def stubs():
+        for nanny in nannies:
+            results = nanny_results(sconfig, periods, taxtables, nanny, nannydata[nanny])
+            for period in periods:
+                yield stubcontext(period, nanny, nannydata[nanny], results)
+
+    if request.args.get('format') == 'zip':
+        def generate():
+            out = ChunkWriter()
+            with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for stub in stubs():
+                    name = '{}_{}.html'.format(stub['nanny'].replace(' ','_'), stub['period'].endDate().strftime('%Y_%m_%d'))
+                    zf.writestr(name, render('paystub.html', sconfig=sconfig, children=children, **stub))
+                    yield out.drain()
+            yield out.drain()
+
+        return Response(stream_with_context(generate()), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=paystubs_{}.zip'.format(g.year)})
+
+    context = dict(sconfig=sconfig, children=children, stubs=stubs())
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template('paystubs.html')
+    return Response(stream_with_context(template.generate(context)), mimetype='text/html')
 
 
 def common_init():
@@ -158,6 +295,8 @@ def common_init():
         return val.quantize(THRENTS)
 
     app.config.from_envvar('SETTINGS_FILE')
+    if app.debug or get_debug_flag() or app.config.get('PROFILE_ENABLED'):
+        app.add_url_rule('/debug/profile', 'profile', profile)
     app.jinja_env.filters['dpercent'] = dpercent
     app.jinja_env.filters['dollar']   = dollar
     app.jinja_env.filters['h2']       = h2
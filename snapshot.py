@@ -0,0 +1,77 @@
+import json
+import os
+import time
+import types
+import urllib.parse
+
+
+# Snapshots are stored one valueRange per file as
+#   <SNAPSHOT_DIR>/<spreadsheet id>/<version>/<quoted range name>.json
+# and a version is whatever sortable name the recorder gave it, the latest one is used unless
+# SNAPSHOT_VERSION picks another.
+
+def _range_file(range_):
+    return urllib.parse.quote(range_, safe='') + '.json'
+
+
+def versions(directory, sheetid):
+    path = os.path.join(directory, sheetid)
+    if not os.path.isdir(path):
+        return []
+    return sorted(v for v in os.listdir(path) if os.path.isdir(os.path.join(path, v)))
+
+
+def latest(directory, sheetid, version=None):
+    # the requested version, or the newest one recorded
+    if version:
+        return version
+    found = versions(directory, sheetid)
+    if not found:
+        raise LookupError("no snapshots of {} in {}".format(sheetid, directory))
+    return found[-1]
+
+
+def save(directory, sheetid, version, ranges, data):
+    # write the valueRanges of a batchGet response for ranges
+    path = os.path.join(directory, sheetid, version)
+    os.makedirs(path, exist_ok=True)
+    for range_, valuerange in zip(ranges, data['valueRanges']):
+        tmpfile = os.path.join(path, '.' + _range_file(range_))
+        with open(tmpfile, 'w') as fp:
+            json.dump(valuerange, fp)
+        os.replace(tmpfile, os.path.join(path, _range_file(range_)))
+
+
+class SnapshotDir():
+    # lookup(sheetid, range) over a snapshot directory, pinned to one version per spreadsheet
+
+    def __init__(self, directory, version=None):
+        self.directory = directory
+        self.version   = version
+
+    def __call__(self, sheetid, range_):
+        path = os.path.join(self.directory, sheetid, latest(self.directory, sheetid, self.version), _range_file(range_))
+        try:
+            with open(path, 'r') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            raise LookupError("snapshot {} has no range {}".format(path, range_))
+
+
+class FakeSheets():
+    # Stands in for service.spreadsheets(), answering values().batchGet() from lookup(sheetid, range)
+    # after sleeping latency seconds the way a round trip to the API would
+
+    def __init__(self, lookup, latency=0):
+        self.lookup  = lookup
+        self.latency = latency
+
+    def values(self):
+        return self
+
+    def batchGet(self, spreadsheetId, ranges):
+        def execute():
+            if self.latency:
+                time.sleep(self.latency)
+            return dict(spreadsheetId=spreadsheetId, valueRanges=[self.lookup(spreadsheetId, r) for r in ranges])
+        return types.SimpleNamespace(execute=execute)
@@ -0,0 +1,203 @@
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import decimal
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from flask import current_app, g
+
+import calc
+import data
+from timing import phase
+
+log = logging.getLogger(__name__)
+
+# results are only good for the code that produced them
+with open(calc.__file__, 'rb') as cfp, open(data.__file__, 'rb') as dfp:
+    CODEHASH = hashlib.sha1(cfp.read() + dfp.read()).hexdigest()
+
+
+def fingerprints(sconfig, periods, taxtables, nanny, ndata, fixed=False):
+    # Chained hash per period over every input that can change its results: config, tax tables,
+    # the period rows up to it and the hours and reimbursements rows up to its end date
+    chain  = hashlib.sha1(CODEHASH.encode())
+    chain.update(repr((vars(sconfig), vars(taxtables), nanny, fixed)).encode())
+    hdates = ndata.hours.dates
+    hidx   = ridx = 0
+    ret    = list()
+
+    for period in periods:
+        end = period.endDate()
+        chain.update(repr(period.data).encode())
+        while hidx < len(hdates) and hdates[hidx] <= end:
+            chain.update(repr(ndata.hours.row(hidx)).encode())
+            hidx += 1
+        while ridx < len(ndata.reimbursements) and ndata.reimbursements[ridx].date <= end:
+            chain.update(repr((ndata.reimbursements[ridx].date, ndata.reimbursements[ridx].amount)).encode())
+            ridx += 1
+        ret.append(chain.hexdigest())
+
+    return ret
+
+
+# Stored rows are JSON, Decimals as strings and ints as numbers so each value comes back as the type and
+# exponent it was saved with
+
+def _values(values):
+    return {k: v if isinstance(v, int) else str(v) for k, v in values.items()}
+
+
+def _decimals(values, zero=decimal.Decimal):
+    return collections.defaultdict(zero, ((k, v if isinstance(v, int) else decimal.Decimal(v)) for k, v in values.items()))
+
+
+def dumps(end, results, ledger):
+    return json.dumps(dict(
+        end     = end.isoformat(),
+        results = {section: _values(values) for section, values in results.items()},
+        ledger  = dict(zero=ledger.zero.__name__, scale=ledger.scale, rates=ledger.rates and [str(r) for r in ledger.rates], hidx=ledger.hidx, ridx=ledger.ridx,
+                       **{name: _values(getattr(ledger, name)) for name in calc.Ledger.TOTALS})))
+
+
+def loads(text):
+    # (end, results, ledger) as dumps was given them
+    row    = json.loads(text)
+    saved  = row['ledger']
+    ledger = calc.Ledger(dict(int=int, Decimal=decimal.Decimal)[saved['zero']])
+    ledger.scale = saved['scale'] and tuple(saved['scale'])
+    ledger.rates = saved['rates'] and [decimal.Decimal(r) for r in saved['rates']]
+    ledger.hidx, ledger.ridx = int(saved['hidx']), int(saved['ridx'])
+    for name in calc.Ledger.TOTALS:
+        setattr(ledger, name, _decimals(saved[name], getattr(ledger, name).default_factory))
+    results = {section: _decimals(values) for section, values in row['results'].items()}
+    return datetime.date.fromisoformat(row['end']), results, ledger
+
+
+class ResultsStore():
+    # SQLite file of calculated period results and the ledger at each period end, keyed by (year, nanny, period)
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS results (year INTEGER, nanny TEXT, period INTEGER, fingerprint TEXT, data TEXT, PRIMARY KEY (year, nanny, period))")
+
+    @contextlib.contextmanager
+    def connect(self):
+        with contextlib.closing(sqlite3.connect(self.path, timeout=10)) as db:
+            with db:
+                yield db
+
+    def load(self, year, nanny, prints):
+        # the leading run of periods whose fingerprints still match, as a nanny_ledger resume tuple
+        with self.connect() as db:
+            rows = {r[0]: r[1:] for r in db.execute("SELECT period, fingerprint, data FROM results WHERE year=? AND nanny=?", (year, nanny))}
+
+        count, done, ledger = 0, dict(), None
+        for idx, fingerprint in enumerate(prints):
+            if idx not in rows or rows[idx][0] != fingerprint:
+                break
+            try:
+                end, results, ledger = loads(rows[idx][1])
+            except (ValueError, TypeError, KeyError, decimal.InvalidOperation) as e:
+                log.warning("unreadable results for {} period {} in {}: {!r}".format(nanny, idx, self.path, e))
+                break
+            done[end] = results
+            count = idx + 1
+
+        return count and (count, done, ledger) or None
+
+    def save(self, year, nanny, periods, prints, results, ledgers):
+        # ledgers are for the last len(ledgers) periods, the ones just calculated
+        first = len(periods) - len(ledgers)
+        rows  = list()
+        for idx, ledger in enumerate(ledgers, first):
+            end = periods[idx].endDate()
+            rows.append((year, nanny, idx, prints[idx], dumps(end, results[end], ledger)))
+
+        with self.connect() as db:
+            db.execute("DELETE FROM results WHERE year=? AND nanny=? AND period>=?", (year, nanny, first))
+            db.executemany("INSERT INTO results VALUES (?,?,?,?,?)", rows)
+
+
+def _open_store():
+    # RESULTS_STORE is the file to use, '' turns the store off, and the default is in data's private temp dir,
+    # the one place that is both writable (only /tmp is on App Engine) and kept to the app's user
+    path = current_app.config.get('RESULTS_STORE')
+    try:
+        if path is None:
+            path = os.path.join(data.private_dir(), 'results.db')
+        return path and ResultsStore(path) or None
+    except (OSError, sqlite3.Error) as e:
+        if path not in _unavailable:  # once, not on every request
+            _unavailable.add(path)
+            log.warning("results store {} unavailable: {}".format(path, e))
+        return None
+
+_unavailable = set()
+
+
+_pool     = (0, None)
+_poollock = threading.Lock()
+
+def _get_pool(processes):
+    global _pool
+    with _poollock:
+        if _pool[0] != processes:
+            if _pool[1]: _pool[1].shutdown(wait=False)
+            _pool = (processes, concurrent.futures.ProcessPoolExecutor(processes))
+        return _pool[1]
+
+
+def all_nanny_results(sconfig, periods, taxtables, nannydata):
+    with phase('calc'):
+        return _all_nanny_results(sconfig, periods, taxtables, nannydata)
+
+
+def _all_nanny_results(sconfig, periods, taxtables, nannydata):
+    # nanny_calculate for each nanny in nannydata, reusing stored results for periods whose inputs haven't
+    # changed.  With CALC_PROCESSES > 1 the nannies are calculated in parallel in a process pool, and
+    # CALC_FIXED_POINT selects the integer row engine.
+    store = _open_store()
+    fixed = current_app.config.get('CALC_FIXED_POINT', False)
+    jobs  = dict()
+    for nanny, ndata in nannydata.items():
+        prints = resume = None
+        if store:
+            prints = fingerprints(sconfig, periods, taxtables, nanny, ndata, fixed)
+            try:
+                resume = store.load(g.year, nanny, prints)
+            except sqlite3.Error as e:
+                log.warning("unable to load results from {}: {}".format(store.path, e))
+        jobs[nanny] = (prints, resume)
+
+    processes = current_app.config.get('CALC_PROCESSES', 0)
+    todo      = [n for n, (prints, resume) in jobs.items() if not resume or resume[0] < len(periods)]
+    futures   = dict()
+    if processes > 1 and len(todo) > 1:
+        pool    = _get_pool(processes)
+        futures = {n: pool.submit(calc.nanny_ledger, sconfig, periods, taxtables, n, nannydata[n], jobs[n][1], fixed) for n in todo}
+
+    ret = dict()
+    for nanny, ndata in nannydata.items():
+        prints, resume = jobs[nanny]
+        if nanny in futures:
+            results, ledgers = futures[nanny].result()
+        else:
+            results, ledgers = calc.nanny_ledger(sconfig, periods, taxtables, nanny, ndata, resume, fixed)
+        if store and ledgers:
+            try:
+                store.save(g.year, nanny, periods, prints, results, ledgers)
+            except sqlite3.Error as e:
+                log.warning("unable to save results to {}: {}".format(store.path, e))
+        ret[nanny] = results
+    return ret
+
+
+def nanny_results(sconfig, periods, taxtables, nanny, ndata):
+    return all_nanny_results(sconfig, periods, taxtables, {nanny: ndata})[nanny]
@@ -0,0 +1,281 @@
+import collections
+import datetime
+import decimal
+from functools import partial
+import json
+import os
+import random
+import types
+
+import pytest
+
+import calc
+import data
+from calc import BOTH, BOTHOT, CENTS, SING, SINGOT, sr, srh
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+def baseline_calculate(sconfig, periods, taxtables, nanny, ndata):
+    # nanny_calculate as it was before the single forward sweep, every period walks the hours from the start
+
+    ret = dict()
+    calcs = list()
+
+    for child in sconfig.children:
+        #             Input Hours Key,  Rate Function,        Destination Keys
+        calcs.append(   ('Both',        partial(srh, BOTH),   [child + ' Gross', child + ' Both']))
+        calcs.append(   ('Both OT',     partial(srh, BOTHOT), [child + ' Gross', child + ' Both OT']))
+        calcs.append(   ('Sick',        partial(srh, BOTH),   [child + ' Gross', child + ' Sick']))
+        calcs.append(   ('Holiday',     partial(srh, BOTH),   [child + ' Gross', child + ' Holiday']))
+        calcs.append(   (child,         partial(sr, SING),    [child + ' Gross', child]))
+        calcs.append(   (child + ' OT', partial(sr, SINGOT),  [child + ' Gross', child + ' OT']))
+
+    for period in periods:
+        start = period.startDate()
+        end   = period.endDate()
+        rates = period.rates(nanny)
+
+        ret[end] = dict()
+        p = ret[end]['hours'] = collections.defaultdict(decimal.Decimal)
+        s = ret[end]['sums'] = collections.defaultdict(decimal.Decimal)
+
+        s['SickAccum'] = 0
+
+        for h in ndata.hours:
+            if h.date > end: break  # don't go past this period
+            s['SickAccum'] += h.hours('Sick Adjust')
+
+            for hrkey, ratefunc, dkeys in calcs:
+                hrs, gross = ratefunc(h.hours(hrkey), rates)
+
+                if hrkey not in ('Sick', 'Holiday'):
+                    s['SickAccum'] += sconfig.sickaccum(nanny, hrs)
+                elif hrkey == 'Sick':
+                    s['SickAccum'] -= hrs
+
+                for dkey in dkeys:
+                    # YTD inclusive
+                    p[dkey + ' YTD'] += hrs
+                    s[dkey + ' YTD'] += gross
+
+                    # This period
+                    if h.date >= start:
+                        p[dkey] += hrs
+                        s[dkey] += gross
+
+        for r in ndata.reimbursements:
+            if r.date > end: break
+            # Full YTD calculations
+            for child in sconfig.children:
+                s[child+' Reimbursements YTD'] += r.amount/2
+
+            if r.date < start: continue
+            for child in sconfig.children:
+                s[child+' Reimbursements'] += r.amount/2
+
+        for child in sconfig.children:
+            for key in (child+' Reimbursements', child+' Reimbursements YTD'):
+                s[key] = s[key].quantize(CENTS, rounding=decimal.ROUND_UP)
+
+
+    ## Taxes and net
+    ytd = collections.defaultdict(decimal.Decimal)
+    for period in periods:
+        start = period.startDate()
+        end   = period.endDate()
+        rates = period.rates(nanny)
+
+        sums = ret[end]
+        w4   = period.withholding(nanny)
+        s    = sums['sums']
+        t    = sums['tax'] = collections.defaultdict(decimal.Decimal)
+        n    = sums['net'] = collections.defaultdict(decimal.Decimal)
+
+        totalgross = decimal.Decimal(0)
+        for child in sconfig.children:
+            totalgross += s[child+' Gross']
+        fed = taxtables.getTax(w4, totalgross)  # fed is calculated as 1 and then divided between employers
+
+        for child in sconfig.children:
+            childytdgross = s[child+' Gross YTD']
+            futagross = wagross = childgross = s[child+' Gross']
+            fedtax = 0
+
+            # Limit for FUTA per year
+            if childytdgross > sconfig.fed_unemployment_base:
+                futagross = max(0, futagross - (childytdgross - sconfig.fed_unemployment_base))
+
+            # Limit for WA taxes per year
+            if childytdgross > sconfig.wa_wage_base:
+                wagross   = max(0, wagross   - (childytdgross - sconfig.wa_wage_base))
+
+            if totalgross: fedtax = ((childgross / totalgross) * fed).quantize(CENTS)
+            ss       = ((childgross * sconfig.social_security)/2).quantize(CENTS)
+            medicare = ((childgross * sconfig.medicare)/2).quantize(CENTS)
+            fedunemp =  (futagross  * sconfig.fed_unemployment).quantize(CENTS)
+            waleave  =  (wagross    * sconfig.family_leave).quantize(CENTS)
+            waunemp  =  (wagross    * sconfig.wa_unemployment).quantize(CENTS)
+
+            employee = fedtax   + ss + medicare + waleave
+            employer = fedunemp + ss + medicare + waunemp
+
+            # rolling count
+            ytd[child+' Fed']       += fedtax
+            ytd[child+' SS1']       += ss
+            ytd[child+' SS2']       += ss
+            ytd[child+' Medicare1'] += medicare
+            ytd[child+' Medicare2'] += medicare
+            ytd[child+' WALeave']  += waleave
+            ytd[child+' WAUnemp']  += waunemp
+            ytd[child+' FedUnemp'] += fedunemp
+            ytd[child+' EmployeeTax'] += employee
+            ytd[child+' EmployerTax'] += employer
+
+            # child
+            t[child+' Fed']       = fedtax
+            t[child+' SS1']       = ss
+            t[child+' SS2']       = ss
+            t[child+' Medicare1'] = medicare
+            t[child+' Medicare2'] = medicare
+            t[child+' WALeave']   = waleave
+            t[child+' WAUnemp']   = waunemp
+            t[child+' FedUnemp']  = fedunemp
+            t[child+' EmployeeTax'] = employee
+            t[child+' EmployerTax'] = employer
+            for copy in ('Fed', 'SS1', 'SS2', 'Medicare1', 'Medicare2', 'WALeave', 'WAUnemp', 'FedUnemp', 'EmployeeTax', 'EmployerTax'):
+                t['{} {} YTD'.format(child, copy)] = ytd['{} {}'.format(child, copy)]
+
+        for child in sconfig.children:
+            ncalc = [(child, child+' ', ''), (child+' YTD', child+' ', ' YTD')]
+            for dest, prefix, suffix in ncalc:
+                n[dest] = (sums['sums'][prefix+'Gross'+suffix] - sums['tax'][prefix+'EmployeeTax'+suffix] + sums['sums'][prefix+'Reimbursements'+suffix]).quantize(CENTS, rounding=decimal.ROUND_UP)
+
+    return ret
+
+
+def recorded(year):
+    # {range name: valueRange} as batchGet returned them for a year's spreadsheet
+    with open(os.path.join(TESTDATA, 'sheets_{}.json'.format(year))) as fp:
+        return json.load(fp)
+
+
+def parse(ranges, year, overlap=False, shuffle=None):
+    # overlap moves some period starts back into the period before, shuffle swaps hours and
+    # reimbursement rows out of date order and adds blank lines
+    sconfig = data.Config(ranges['Config'])
+    periods = data.PayPeriod.parseSheet(ranges['PayPeriods'])
+    if year <= 2019:
+        taxtables = data.TaxTablesPre20(ranges['Single Bracket'], ranges['Married Bracket'])
+    else:
+        taxtables = data.TaxTablesPost20(ranges['Tax Tables'])
+    if overlap:
+        for period in periods[3:6] + periods[-3:-1]:
+            period.start -= datetime.timedelta(days=4)
+
+    nannydata = dict()
+    for nanny in sconfig.nannies:
+        hours = [list(row) for row in ranges[nanny + ' Hours']['values']]
+        reimb = [list(row) for row in ranges[nanny + ' Reimbursements']['values']]
+        if shuffle is not None:
+            rnd = random.Random(shuffle)
+            for rows, count, span in ((hours, 12, 15), (reimb, 3, 2)):
+                for _ in range(count):
+                    ii = rnd.randrange(2, len(rows) - 1)
+                    jj = min(len(rows) - 1, ii + rnd.randint(1, span))
+                    rows[ii], rows[jj] = rows[jj], rows[ii]
+            hours.insert(rnd.randrange(2, len(hours)), [])
+        nannydata[nanny] = types.SimpleNamespace(hours=data.Hours.parseSheet(dict(values=hours)),
+                                                 reimbursements=data.Reimbursement.parseSheet(dict(values=reimb)))
+    return sconfig, periods, taxtables, nannydata
+
+
+def compare(expected, got):
+    # every value of every period matches, down to the exponent where both have the key
+    assert expected.keys() == got.keys()
+    count = 0
+    for end in expected:
+        for section in ('hours', 'sums', 'tax', 'net'):
+            a, b = expected[end][section], got[end][section]
+            for key in set(a) | set(b):
+                va, vb = a.get(key, decimal.Decimal(0)), b.get(key, decimal.Decimal(0))
+                assert va == vb, (end, section, key, va, vb)
+                if key in a and key in b:
+                    assert str(va) == str(vb), (end, section, key, va, vb)
+                count += 1
+    return count
+
+
+@pytest.mark.parametrize('year', [2019, 2021])
+@pytest.mark.parametrize('overlap', [False, True])
+@pytest.mark.parametrize('shuffle', [None, 1, 2])
+def test_sweep_matches_baseline(year, overlap, shuffle):
+    sconfig, periods, taxtables, nannydata = parse(recorded(year), year, overlap, shuffle)
+    assert len({tuple(p.rates(n)) for p in periods for n in sconfig.nannies}) > len(sconfig.nannies)  # rates change mid year
+    for nanny, ndata in nannydata.items():
+        expected = baseline_calculate(sconfig, periods, taxtables, nanny, ndata)
+        assert compare(expected, calc.nanny_calculate(sconfig, periods, taxtables, nanny, ndata)) > 0
+
+
+def random_sheet(seed):
+    # one nanny over a few random periods, hours with 0 to 4 decimal places and the odd negative correction,
+    # rates with up to 3 and a SickAccum rate that may or may not divide evenly
+    rnd  = random.Random(seed)
+    kids = ['Alice', 'Bob'][:rnd.randint(1, 2)]
+
+    def number(places, low, high):
+        return '{:.{}f}'.format(rnd.uniform(low, high), places)
+
+    config = [['Nanny 1', 'Jane Doe\n1 Main St\n555-00-0001'], ['SickAccum 1', rnd.choice(['0', '40', '30', '0.5', '12.5', '3', '16', '7'])]]
+    for ii, kid in enumerate(kids, 1):
+        config += [['Child {}'.format(ii), kid + ' Sample'], ['Employer {}'.format(ii), 'Sample{} 00-000000{}'.format(ii, ii)]]
+    config += [['Social Security', '12.4%'], ['Medicare', '2.9%'], ['Fed Unemployment', '0.6%'], ['Fed Unemployment Base', '7,000'],
+               ['WA Wage Base', '52,700'], ['Family Leave', '0.153%'], ['WA Unemployment', '1.2%']]
+
+    periods = [['Start', 'End', 'PayDate', 'Jane Doe Rates', 'Jane Doe Withholding']]
+    day = datetime.date(2020, 1, 1)
+    for _ in range(rnd.randint(3, 30)):
+        end   = day + datetime.timedelta(days=rnd.choice([6, 13]))
+        start = day - datetime.timedelta(days=rnd.choice([0, 0, 0, 3]))
+        rates = ', '.join(number(rnd.choice([0, 1, 2, 3]), 10, 45) for _ in range(4))
+        periods.append([start.strftime('%m/%d/%Y'), end.strftime('%m/%d/%Y'), end.strftime('%m/%d/%Y'), rates, '0, 0, 0, 0, 0, 0'])
+        day = end + datetime.timedelta(days=1)
+
+    header = ['Day', 'Date'] + [k + s for k in kids for s in ('', ' OT')] + ['Both', 'Both OT', 'Sick', 'Holiday', 'Sick Adjust']
+    places = {name: rnd.choice([0, 1, 2, 2, 3, 4]) for name in header}
+    hours  = [['Hours'], header]
+    date   = datetime.date(2020, 1, 1)
+    while date < day:
+        row = [date.strftime('%a'), date.strftime('%m/%d/%Y')]
+        for name in header[2:]:
+            low = name == 'Sick Adjust' and -2 or rnd.random() < 0.05 and -1 or 0
+            row.append(rnd.random() < 0.4 and number(places[name], low, 10) or '')
+        hours.append(row)
+        date += datetime.timedelta(days=rnd.randint(1, 3))
+
+    reimb  = [['Reimbursements'], ['Date', 'Amount', 'Notes'], ['01/05/2020', '10.01', 'mileage'], ['02/05/2020', '3.33', 'parking']]
+    tables = [['w4[0]=0'], ['w4[1]=0'], ['0', '10,000', '0', '0%', '4,300'], ['10,000', '99,999,999', '0', '10%', '4,300']]
+    ndata  = types.SimpleNamespace(hours=data.Hours.parseSheet(dict(values=hours)), reimbursements=data.Reimbursement.parseSheet(dict(values=reimb)))
+    return data.Config(dict(values=config)), data.PayPeriod.parseSheet(dict(values=periods)), data.TaxTablesPost20(dict(values=tables)), ndata
+
+
+@pytest.mark.parametrize('seeds', [range(0, 50), range(50, 100)])
+def test_fixed_point_matches_decimal(seeds):
+    for seed in seeds:
+        sconfig, periods, taxtables, ndata = random_sheet(seed)
+        expected = calc.nanny_calculate(sconfig, periods, taxtables, 'Jane Doe', ndata)
+        got      = calc.nanny_calculate(sconfig, periods, taxtables, 'Jane Doe', ndata, fixed=True)
+        for end in expected:
+            for section in ('hours', 'sums', 'tax', 'net', 'rollup'):
+                assert set(expected[end][section]) == set(got[end][section]), (seed, end, section)
+            for key, value in expected[end]['rollup'].items():
+                assert str(value) == str(got[end]['rollup'][key]), (seed, end, key)
+        assert compare(expected, got) > 0, seed
+
+
+@pytest.mark.parametrize('year', [2019, 2021])
+def test_fixed_point_matches_baseline(year):
+    sconfig, periods, taxtables, nannydata = parse(recorded(year), year, overlap=True, shuffle=3)
+    for nanny, ndata in nannydata.items():
+        expected = baseline_calculate(sconfig, periods, taxtables, nanny, ndata)
+        compare(expected, calc.nanny_calculate(sconfig, periods, taxtables, nanny, ndata, fixed=True))
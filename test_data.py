@@ -0,0 +1,274 @@
+import datetime
+import decimal
+import json
+import os
+import pickle
+import random
+import socket
+import types
+
+import flask
+import httplib2
+import pytest
+
+import data
+from test_calc import recorded
+
+D = decimal.Decimal
+HEADER = ['Day', 'Date', 'Alice', 'Alice OT']
+
+
+def hours_sheet(rows):
+    return dict(values=[['Hours'], HEADER] + rows)
+
+
+def test_blank_hours_rows_keep_dates_aligned():
+    # batchGet returns [] for an empty line in the sheet
+    table = data.Hours.parseSheet(hours_sheet([
+        ['Mon', '01/06/2020', '1'],
+        [],
+        ['Wed', '01/08/2020', '2', '4'],
+        ['Thu', '01/09/2020', '3'],
+        ['', '', '', ''],
+    ]))
+    assert len(table) == 3
+    got = {h.date: (h.hours('Alice'), h.hours('Alice OT')) for h in table}
+    assert got == {datetime.date(2020, 1, 6): (D(1), D(0)),
+                   datetime.date(2020, 1, 8): (D(2), D(4)),
+                   datetime.date(2020, 1, 9): (D(3), D(0))}
+    assert [table.row(ii)[1] for ii in range(len(table))] == ['01/06/2020', '01/08/2020', '01/09/2020']
+    assert table.scaled('Alice', 3) == [1000, 2000, 3000]
+
+
+def test_hours_data_only_converts_what_is_read():
+    table = data.Hours.parseSheet(hours_sheet([['Mon', '01/06/2020', '1.5'], ['Tue', '01/07/2020', '', '2']]))
+    hrs   = table[1]
+    assert hrs.data['Alice OT'] == D(2) and hrs.data.get('Alice') == D(0) and hrs.data.get('Sick', 0) == 0
+    assert 'Sick' not in hrs.data and list(hrs.data) == ['Alice', 'Alice OT']
+    assert dict(table[0].data) == {'Alice': D('1.5'), 'Alice OT': D(0)}
+
+    table = data.Hours.parseSheet(hours_sheet([['Mon', '01/06/2020', '1.5']]))
+    table[0].data['Alice OT']
+    assert list(table.columns) == ['Alice OT']
+    with pytest.raises(TypeError):
+        table[0].data['Alice'] = D(1)
+
+
+def test_hours_without_a_date_are_an_error():
+    with pytest.raises(ValueError, match='Hours row 4'):
+        data.Hours.parseSheet(hours_sheet([['Mon', '01/06/2020', '1'], ['Tue', '', '2']]))
+
+
+def scan_tax(tables, w4, gross):
+    # TaxTablesPost20.getTax before the tables were compiled, first matching row in sheet order
+    w4c     = {x: w4[ii] for ii, x in enumerate(data.TaxTablesPost20.W4COLS)}
+    table   = tables.get((w4c['1c'], w4c['2c']), [])
+    periods = 26
+    annual  = (gross * periods) + w4c['4a']
+
+    for row in table:
+        (start, end, base, bracket, standard) = list(map(data.str2dec, row))
+        deductions = w4c['4b'] + standard
+        adjannwage = max(annual - deductions, 0)
+
+        if start <= adjannwage < end:
+            basetax  = decimal.Decimal((((adjannwage - start) * bracket) + base) / periods)
+            credits  = decimal.Decimal(w4c['3'] / periods)
+            withhold = max(basetax - credits, 0) + w4c['4c']
+            return withhold.quantize(decimal.Decimal('0.01'))
+    return 0
+
+
+def random_tax_table(rnd, kind):
+    # rows of one table as the sheet has them, shuffled, gapped, mixed standard deductions or overlapping
+    standard = rnd.choice(['4,300', '12,900', '8,600'])
+    bounds   = sorted(rnd.sample(range(1000, 400000, 250), rnd.randint(1, 7)))
+    rows, start, base = list(), 0, 0
+    for end in bounds + [9999999]:
+        rate = rnd.choice(['0%', '10%', '12%', '22%', '24%', '35%', '12.5%'])
+        rows.append(['{:,}'.format(start), '{:,}'.format(end), '{:,}'.format(base), rate, standard])
+        base  += (end - start) * data.str2dec(rate)
+        start  = end + (rnd.randint(1, 3000) if kind == 'gapped' else 0)
+    if kind == 'mixed':
+        rnd.choice(rows)[4] = rnd.choice(['4,300', '12,900', '8,601'])
+    if kind == 'overlapping' and len(rows) > 1:
+        row    = rnd.choice(rows[1:])
+        row[0] = '{:,}'.format(int(row[0].replace(',', '')) - rnd.randint(1, 900))
+    if kind != 'sorted':
+        rnd.shuffle(rows)
+    return rows
+
+
+def test_compiled_tax_tables_match_row_scan():
+    rnd = random.Random(5)
+    for kind in ('sorted', 'shuffled', 'gapped', 'mixed', 'overlapping'):
+        for _ in range(12):
+            tables = {w4: random_tax_table(rnd, kind) for w4 in ((0, 0), (0, 1), (1, 0), (1, 1)) if rnd.random() < 0.9}
+            sheet  = [cell for w4, rows in tables.items() for cell in [['w4[0]={}'.format(w4[0])], ['w4[1]={}'.format(w4[1])]] + rows]
+            taxtables = data.TaxTablesPost20(dict(values=sheet))
+            again     = pickle.loads(pickle.dumps(taxtables))
+
+            cases = list()
+            for _ in range(300):
+                w4    = [rnd.randint(0, 1), rnd.randint(0, 2)] + [D(rnd.choice([0, 0, rnd.randint(0, 80000)])) / rnd.choice([1, 100]) for _ in range(4)]
+                gross = D(rnd.randint(0, 2000000)) / 100
+                cases.append((w4, gross))
+            # exactly on, and a cent either side of, every bracket edge
+            for (c1, c2), rows in tables.items():
+                for row in rows:
+                    for edge in map(data.str2dec, row[:2]):
+                        for cent in (D('-0.01'), D(0), D('0.01')):
+                            w4 = [c1, c2, D(rnd.randint(0, 4000)), D(0), D(rnd.randint(0, 9000)), D(0)]
+                            gross = D(rnd.randint(0, 500000)) / 100
+                            w4[3] = edge + cent + w4[4] + data.str2dec(row[4]) - gross * 26  # 4a puts the adjusted wage on the edge
+                            cases.append((w4, gross))
+
+            cents    = lambda taxes: [(type(t), str(t)) for t in taxes]  # to the cent, exponent and all
+            expected = cents(scan_tax(tables, w4, gross) for w4, gross in cases)
+            for engine in (taxtables, again):  # and after the pickle trip to a pool worker
+                assert cents(engine.getTax(w4, gross) for w4, gross in cases) == expected, kind
+                assert cents(engine.getTaxMany(*zip(*cases))) == expected, kind
+
+
+class FakeService():
+    # spreadsheets() and files() of the googleapiclient services over recorded ranges, counting the calls
+    def __init__(self, ranges):
+        self.ranges    = ranges
+        self.modified  = '2021-01-01T00:00:00.000Z'
+        self.failure   = None
+        self.batchgets = 0
+        self.lookups   = 0
+
+    def values(self):
+        return self
+
+    def batchGet(self, spreadsheetId, ranges):
+        def execute():
+            self.batchgets += 1
+            return dict(spreadsheetId=spreadsheetId, valueRanges=[self.ranges[r] for r in ranges])
+        return types.SimpleNamespace(execute=execute)
+
+    def get(self, fileId, fields):
+        def execute():
+            self.lookups += 1
+            if self.failure:
+                raise self.failure
+            return dict(modifiedTime=self.modified)
+        return types.SimpleNamespace(execute=execute)
+
+
+@pytest.fixture
+def sheets(tmp_path, monkeypatch):
+    # an app on a fake service with no TTL, so every request after the first checks the revision
+    app = flask.Flask(__name__, root_path=os.path.dirname(os.path.abspath(__file__)), instance_path=str(tmp_path))
+    app.config.update(SPREADSHEET_ID_2021='sheet2021', SHEETS_CACHE_TTL=0)
+    service = FakeService(recorded(2021))
+    monkeypatch.setattr(data, 'sheetcache', data.SheetCache())
+    monkeypatch.setattr(data, '_get_client', lambda name, version, resource: service)
+
+    def request():
+        with app.app_context():
+            flask.g.year = 2021
+            return data.get_config_data()
+    return types.SimpleNamespace(app=app, service=service, request=request)
+
+
+def test_unchanged_revision_skips_batchget(sheets):
+    first = sheets.request()
+    assert sheets.service.batchgets == 1
+    assert sheets.request() is first
+    assert sheets.request() is first
+    assert sheets.service.batchgets == 1
+    assert sheets.service.lookups == 3
+
+
+def test_revision_lookup_is_timed_as_fetch(sheets):
+    # a cached entry past its TTL only looks the revision up, that network time is still fetch
+    sheets.request()
+    with sheets.app.app_context():
+        flask.g.year    = 2021
+        flask.g.timings = dict()
+        data.get_config_data()
+        assert flask.g.timings['fetch'][1] == 1
+    assert (sheets.service.batchgets, sheets.service.lookups) == (1, 2)
+
+
+def test_changed_revision_refetches(sheets):
+    first = sheets.request()
+    sheets.service.modified = '2021-02-01T00:00:00.000Z'
+    assert sheets.request() is not first
+    assert sheets.service.batchgets == 2
+    sheets.request()
+    assert sheets.service.batchgets == 2
+
+
+@pytest.mark.parametrize('failure', [httplib2.ServerNotFoundError('no route'), socket.timeout('timed out'), ConnectionResetError(),
+                                     data.googleapiclient.errors.HttpError(httplib2.Response(dict(status=500)), b'')])
+def test_failed_revision_lookup_refetches(sheets, failure):
+    sheets.request()
+    sheets.service.failure = failure
+    sheets.request()
+    sheets.request()
+    assert sheets.service.batchgets == 3
+    sheets.service.failure = None
+    sheets.request()
+    sheets.request()
+    assert sheets.service.batchgets == 4
+
+
+def test_failed_drive_client_refetches(sheets, monkeypatch):
+    sheets.request()
+    def broken(name, version, resource):
+        if name == 'drive':
+            raise data.googleapiclient.errors.InvalidJsonError('bad discovery document')
+        return sheets.service
+    monkeypatch.setattr(data, '_get_client', broken)
+    sheets.request()
+    assert sheets.service.batchgets == 2
+
+
+def discovery(root):
+    return json.dumps(dict(name='sheets', version='v4', rootUrl=root, baseUrl=root, servicePath='', resources=dict()))
+
+
+def test_discovery_documents_must_point_at_googleapis():
+    assert data._trusted_document(discovery('https://sheets.googleapis.com/'))
+    assert data._trusted_document(discovery('https://www.googleapis.com/'))
+    for root in ('https://sheets.googleapis.com.example.com/', 'http://sheets.googleapis.com/', 'https://evil.example/', None):
+        assert not data._trusted_document(discovery(root))
+    assert not data._trusted_document('not json')
+
+
+def test_private_dir_refuses_a_shared_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(data.tempfile, 'gettempdir', lambda: str(tmp_path))
+    path = data.private_dir()
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    os.chmod(path, 0o777)
+    with pytest.raises(PermissionError):
+        data.private_dir()
+
+
+def test_planted_discovery_document_is_refetched(tmp_path, monkeypatch):
+    monkeypatch.setattr(data.tempfile, 'gettempdir', lambda: str(tmp_path))
+    app = flask.Flask(__name__, root_path=os.path.dirname(os.path.abspath(__file__)), instance_path=str(tmp_path))
+    app.config.update(DISCOVERY_DIR=str(tmp_path / 'bundled'))
+    planted = os.path.join(data.private_dir(), 'discovery-sheets.v4.json')
+    with open(planted, 'w') as fp:
+        fp.write(discovery('https://evil.example/'))
+
+    fetched = list()
+    class Http():
+        def request(self, uri):
+            fetched.append(uri)
+            return httplib2.Response(dict(status=200)), discovery('https://sheets.googleapis.com/').encode()
+    monkeypatch.setattr(data.googleapiclient.http, 'build_http', Http)
+    with app.app_context():
+        assert json.loads(data._discovery_document('sheets', 'v4'))['rootUrl'] == 'https://sheets.googleapis.com/'
+        assert data._discovery_document('sheets', 'v4') == open(planted).read()
+    assert len(fetched) == 1
+
+    # and a fetched document that points elsewhere is refused
+    os.remove(planted)
+    monkeypatch.setattr(Http, 'request', lambda self, uri: (httplib2.Response(dict(status=200)), discovery('https://evil.example/').encode()))
+    with app.app_context(), pytest.raises(data.googleapiclient.errors.InvalidJsonError):
+        data._discovery_document('sheets', 'v4')
@@ -0,0 +1,31 @@
+import importlib
+
+import pytest
+
+
+@pytest.fixture
+def load_main(tmp_path, monkeypatch):
+    # main configures itself on import from SETTINGS_FILE
+    def load(settings, env='production'):
+        path = tmp_path / 'settings.cfg'
+        path.write_text(settings)
+        monkeypatch.setenv('SETTINGS_FILE', str(path))
+        monkeypatch.setenv('FLASK_ENV', env)
+        monkeypatch.delenv('FLASK_DEBUG', raising=False)
+        import main
+        return importlib.reload(main)
+    return load
+
+
+def test_profile_toggle_is_off_in_production(load_main):
+    main = load_main("RESULTS_STORE = ''\n")
+    assert main.app.test_client().get('/debug/profile').status_code == 404
+
+
+@pytest.mark.parametrize('settings, env', [("PROFILE_ENABLED = True\n", 'production'), ("", 'development')])
+def test_profile_toggle_when_enabled(load_main, settings, env):
+    main = load_main("RESULTS_STORE = ''\n" + settings, env)
+    response = main.app.test_client().get('/debug/profile')
+    assert response.status_code == 200
+    assert response.get_json()['armed']
+    assert main.timing._take_profile()
@@ -0,0 +1,130 @@
+import os
+
+import flask
+from flask import g
+import pytest
+
+import calc
+import store
+from test_calc import parse, recorded
+
+
+def flat(results):
+    # every value of every nanny's periods as a string, so exponents count too
+    return {(nanny, end, section, key): str(value)
+            for nanny, periods in results.items()
+            for end, sections in periods.items()
+            for section, values in sections.items()
+            for key, value in values.items()}
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = flask.Flask(__name__, root_path=os.path.dirname(os.path.abspath(__file__)), instance_path=str(tmp_path / 'instance'))
+    yield app
+    processes, pool = store._pool
+    if pool:
+        pool.shutdown()
+    store._pool = (0, None)
+
+
+@pytest.mark.parametrize('year', [2019, 2021])
+def test_process_pool_matches_serial(app, tmp_path, year):
+    sconfig, periods, taxtables, nannydata = parse(recorded(year), year, overlap=True)
+    assert len(nannydata) > 1
+    outputs = dict()
+    for processes in (0, 2):
+        for path in ('', str(tmp_path / 'results-{}.db'.format(processes))):
+            app.config.update(RESULTS_STORE=path, CALC_PROCESSES=processes)
+            for attempt in (1, 2):  # the second one resumes from the store when there is one
+                with app.app_context():
+                    g.year = year
+                    outputs[processes, path, attempt] = flat(store.all_nanny_results(sconfig, periods, taxtables, nannydata))
+    assert store._pool[1] is not None
+    expected = outputs[0, '', 1]
+    assert expected
+    for key, output in outputs.items():
+        assert output == expected, key
+
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_stored_rows_round_trip(app, tmp_path, fixed):
+    year = 2021
+    sconfig, periods, taxtables, nannydata = parse(recorded(year), year)
+    nanny, ndata = next(iter(nannydata.items()))
+    results, ledgers = calc.nanny_ledger(sconfig, periods, taxtables, nanny, ndata, fixed=fixed)
+    for period, ledger in zip(periods, ledgers):
+        end = period.endDate()
+        loaded, again, copy = store.loads(store.dumps(end, results[end], ledger))
+        assert loaded == end
+        assert flat({nanny: {end: again}}) == flat({nanny: {end: results[end]}})
+        assert copy.zero is ledger.zero and copy.scale == ledger.scale and copy.rates == ledger.rates and (copy.hidx, copy.ridx) == (ledger.hidx, ledger.ridx)
+        for name in calc.Ledger.TOTALS:
+            assert {k: (type(v), str(v)) for k, v in getattr(copy, name).items()} == {k: (type(v), str(v)) for k, v in getattr(ledger, name).items()}
+            assert getattr(copy, name).default_factory is getattr(ledger, name).default_factory
+
+    # a loaded ledger carries the sweep on to the same results
+    count  = len(periods) // 2
+    end    = periods[count-1].endDate()
+    ledger = store.loads(store.dumps(end, results[end], ledgers[count-1]))[2]
+    resume = (count, {p.endDate(): results[p.endDate()] for p in periods[:count]}, ledger)
+    resumed, _ = calc.nanny_ledger(sconfig, periods, taxtables, nanny, ndata, resume, fixed)
+    assert flat({nanny: resumed}) == flat({nanny: results})
+
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_resume_after_an_edit_with_more_decimal_places(app, tmp_path, fixed):
+    # a row in the last periods gains a fourth decimal place, the stored earlier periods still match
+    year   = 2021
+    ranges = recorded(year)
+    app.config.update(RESULTS_STORE=str(tmp_path / 'results.db'), CALC_FIXED_POINT=fixed)
+    with app.app_context():
+        g.year = year
+        store.all_nanny_results(*parse(ranges, year))
+
+        sconfig, periods, taxtables, nannydata = parse(ranges, year)
+        nanny = sconfig.nannies[0]
+        hours = ranges[nanny + ' Hours']['values']
+        row   = max(range(2, len(hours)), key=lambda ii: hours[ii][1][-4:] + hours[ii][1][:5])  # the last day, m/d/yyyy
+        hours[row] = hours[row][:2] + ['1.2345', '0.0625']
+        sconfig, periods, taxtables, nannydata = parse(ranges, year)
+        prints = store.fingerprints(sconfig, periods, taxtables, nanny, nannydata[nanny], fixed)
+        assert store._open_store().load(year, nanny, prints)[0] == len(periods) - 1
+
+        resumed = flat(store.all_nanny_results(sconfig, periods, taxtables, nannydata))
+    expected = flat({n: calc.nanny_calculate(sconfig, periods, taxtables, n, ndata) for n, ndata in nannydata.items()})
+    assert resumed == expected
+
+
+def test_default_store_is_private_to_the_app(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(store.data.tempfile, 'gettempdir', lambda: str(tmp_path))
+    with app.app_context():
+        results = store._open_store()
+    assert os.path.dirname(results.path) == store.data.private_dir()
+    assert os.stat(os.path.dirname(results.path)).st_mode & 0o077 == 0
+
+
+def test_unavailable_store_is_logged_once(app, tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(store.data.tempfile, 'gettempdir', lambda: str(tmp_path))
+    monkeypatch.setattr(store, '_unavailable', set())
+    os.chmod(store.data.private_dir(), 0o755)
+    with app.app_context():
+        assert store._open_store() is None
+        assert store._open_store() is None
+    assert len([r for r in caplog.records if 'unavailable' in r.getMessage()]) == 1
+
+
+def test_unreadable_rows_are_recalculated(app, tmp_path):
+    year = 2021
+    sconfig, periods, taxtables, nannydata = parse(recorded(year), year)
+    app.config.update(RESULTS_STORE=str(tmp_path / 'results.db'))
+    with app.app_context():
+        g.year = year
+        expected = flat(store.all_nanny_results(sconfig, periods, taxtables, nannydata))
+        results = store._open_store()
+        with results.connect() as db:
+            db.execute("UPDATE results SET data=? WHERE period=3", (b'\x80\x04not json',))
+        nanny = next(iter(nannydata))
+        prints = store.fingerprints(sconfig, periods, taxtables, nanny, nannydata[nanny])
+        assert results.load(year, nanny, prints)[0] == 3
+        assert flat(store.all_nanny_results(sconfig, periods, taxtables, nannydata)) == expected
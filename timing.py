@@ -0,0 +1,84 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from flask import current_app, g, has_app_context, request
+
+log = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def phase(name):
+    # Adds the time spent in the block to the named phase of the current request, outside of a
+    # request (bench.py, pool workers) it does nothing
+    if not has_app_context() or not hasattr(g, 'timings'):
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        total, count = g.timings.get(name, (0.0, 0))
+        g.timings[name] = (total + time.perf_counter() - start, count + 1)
+
+
+_profilenext = False
+_profilelock = threading.Lock()
+
+def arm_profile():
+    # the next request is run under cProfile
+    global _profilenext
+    with _profilelock:
+        _profilenext = True
+
+
+def _take_profile():
+    global _profilenext
+    with _profilelock:
+        armed, _profilenext = _profilenext, False
+    return armed
+
+
+def profile_dir():
+    return current_app.config.get('PROFILE_DIR', tempfile.gettempdir())
+
+
+def before_request():
+    g.timings  = dict()
+    g.reqstart = time.perf_counter()
+    g.profile  = None
+    if request.endpoint != 'profile' and _take_profile():
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+def after_request(response):
+    if not hasattr(g, 'timings'):
+        return response
+    total = time.perf_counter() - g.reqstart
+
+    if g.profile:
+        g.profile.disable()
+        path = os.path.join(profile_dir(), 'nanny-{}-{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'), request.endpoint))
+        g.profile.dump_stats(path)
+        g.profile = None
+        log.warning("profile of {} written to {}".format(request.path, path))
+
+    metrics = ['{};dur={:.1f}'.format(name, secs * 1000) for name, (secs, count) in g.timings.items()]
+    response.headers['Server-Timing'] = ', '.join(metrics + ['total;dur={:.1f}'.format(total * 1000)])
+
+    log.info(json.dumps(dict(path=request.path, status=response.status_code, total=round(total, 4),
+                    phases={name: dict(secs=round(secs, 4), count=count) for name, (secs, count) in g.timings.items()})))
+    return response
+
+
+def teardown_request(exc):
+    # a request that raised never reaches after_request
+    if getattr(g, 'profile', None):
+        g.profile.disable()
+        g.profile = None
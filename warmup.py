@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Keeps the sheet cache and results store warm so requests don't pay for the Sheets fetch and calc.
+# Runs as a thread in the app with PREFETCH_INTERVAL set (seconds), or from the app directory as
+#   SETTINGS_FILE=settings.cfg python3 warmup.py [--interval N] [year ...]
+# which refreshes the results store once (or every N seconds) for the given or all configured years.
+
+import argparse
+import logging
+import threading
+import time
+
+from flask import g
+
+import data
+import store
+
+log = logging.getLogger(__name__)
+
+
+def years(app):
+    return sorted(int(k[-4:]) for k in app.config if k.startswith('SPREADSHEET_ID_'))
+
+
+def refresh_year(app, year):
+    # revalidate every range a page can ask for and bring the stored results up to date
+    with app.app_context():
+        g.year    = year
+        g.refresh = True
+        sconfig, periods = data.get_config_data()
+        taxtables, nannydata = data.get_all_nanny_data(sconfig.nannies)
+        data.get_tax_data()
+        for nanny in sconfig.nannies:
+            data.get_nanny_data(nanny)
+        store.all_nanny_results(sconfig, periods, taxtables, nannydata)
+
+
+def refresh(app, only=None):
+    for year in only or years(app):
+        start = time.perf_counter()
+        try:
+            refresh_year(app, year)
+            log.info("refreshed {} in {:.2f}s".format(year, time.perf_counter() - start))
+        except Exception:
+            log.exception("unable to refresh {}".format(year))
+
+
+class Prefetcher(threading.Thread):
+    def __init__(self, app, interval, only=None):
+        super().__init__(name='prefetch', daemon=True)
+        self.app      = app
+        self.interval = interval
+        self.only     = only
+        self.stopped  = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            refresh(self.app, self.only)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+_prefetcher = None
+
+def start(app):
+    global _prefetcher
+    if _prefetcher is None and app.config.get('PREFETCH_INTERVAL'):
+        _prefetcher = Prefetcher(app, app.config['PREFETCH_INTERVAL'])
+        _prefetcher.start()
+    return _prefetcher
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="refresh nanny-reports sheet data and results")
+    parser.add_argument('--interval', type=float, help="keep refreshing every this many seconds")
+    parser.add_argument('years', type=int, nargs='*')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    import main
+    if args.interval:
+        Prefetcher(main.app, args.interval, args.years).run()
+    else:
+        refresh(main.app, args.years)